@@ -0,0 +1,68 @@
+#
+# Copyright (C) 2015 CGI IT UK Ltd
+# All rights reserved.
+#
+
+from datetime import datetime, timedelta
+
+from trac.admin.api import IAdminCommandProvider
+from trac.core import Component, implements
+from trac.util.datefmt import utc
+from trac.util.text import printout
+
+from agiletools.api import AgileToolsSystem
+
+class AgileToolsAdmin(Component):
+    """trac-admin commands for maintaining ticket positions."""
+
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+    def get_admin_commands(self):
+        yield ('agiletools backfill', '[limit]',
+               """Give tickets without an explicit position one
+
+               Tickets are appended after all positioned tickets, in the
+               order they are currently shown in, in batches of
+               [agiletools] backfill_batch_size tickets per transaction.
+               The command can be interrupted and run again at any time.
+               """,
+               None, self._do_backfill)
+        yield ('agiletools compact-history', '[days]',
+               """Collapse old ticket moves into one row per ticket and day
+
+               Moves older than [days] days (by default [agiletools]
+               history_retention_days) are compacted, one day per
+               transaction. An interrupted run continues from the last
+               compacted day.
+               """,
+               None, self._do_compact_history)
+        yield ('agiletools renumber', '[gap]',
+               """Renumber ticket positions into an evenly spaced sequence
+
+               Positions become 0, [gap], 2 * [gap], ... in the current
+               order, by default using [agiletools] position_gap. Tickets
+               are renumbered in batches, and keep their order throughout.
+               Best run while nobody is reordering the backlog.
+               """,
+               None, self._do_renumber)
+
+    def _do_backfill(self, limit=None):
+        if limit is not None:
+            limit = int(limit)
+        count = AgileToolsSystem(self.env).backfill(limit=limit)
+        printout("Positioned %d tickets" % count)
+
+    def _do_compact_history(self, days=None):
+        ats = AgileToolsSystem(self.env)
+        before = None
+        if days is not None:
+            before = datetime.now(utc) - timedelta(days=int(days))
+        removed = ats.compact_history(before=before)
+        printout("Removed %d position history rows" % removed)
+
+    def _do_renumber(self, gap=None):
+        if gap is not None:
+            gap = int(gap)
+        count = AgileToolsSystem(self.env).renumber(gap=gap)
+        printout("Renumbered %d tickets" % count)
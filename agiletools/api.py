@@ -3,19 +3,119 @@
 # All rights reserved.
 #
 
-from datetime import datetime
+import hashlib
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
 
 from trac.web.api import ITemplateStreamFilter, IRequestFilter
+from trac.config import ChoiceOption, IntOption, ListOption
 from trac.core import Component, implements, TracError, Interface, ExtensionPoint
 from trac.db import DatabaseManager
 from trac.env import IEnvironmentSetupParticipant
-from trac.util.datefmt import to_utimestamp, utc
+from trac.perm import PermissionSystem
+from trac.ticket.api import ITicketChangeListener
+from trac.util.datefmt import from_utimestamp, to_utimestamp, utc
 
 from agiletools import db_default
+from agiletools.cache import LRUCache
+
+class _Scope(object):
+    """The tickets which are ranked against each other: every ticket, or
+    only those in `milestone` (`''` for tickets without a milestone)."""
+
+    def __init__(self, milestone=None):
+        self.milestone = milestone
+
+    def sql(self, column='ticket'):
+        """Return an SQL condition limiting `column` to the tickets in the
+        scope, and its arguments."""
+        if self.milestone is None:
+            return "1=1", []
+        elif self.milestone:
+            return ("%s IN (SELECT id FROM ticket WHERE milestone = %%s)"
+                    % column, [self.milestone])
+        else:
+            return ("%s IN (SELECT id FROM ticket "
+                    "WHERE milestone IS NULL OR milestone = '')" % column, [])
+
+def milestones_sql(names, column='milestone'):
+    """Return an SQL condition limiting `column` to the milestones in
+    `names` (`''` for tickets without a milestone), and its arguments."""
+    named = [name for name in names if name]
+    clauses = []
+    if named:
+        clauses.append("%s IN (%s)" % (column, ",".join(["%s"] * len(named))))
+    if len(named) < len(names):
+        clauses.append("%s IS NULL OR %s=''" % (column, column))
+    return "(%s)" % " OR ".join(clauses or ["1=0"]), named
+
+def chunked_in(cursor, sql, ids, chunk_size=500, args=()):
+    """Execute `sql` once for every `chunk_size` of `ids` and yield the
+    rows of all of them.
+
+    `sql` holds a `%s` where the placeholders for a chunk of ids go, so its
+    own placeholders are written `%%s`. The ids follow `args`.
+    """
+    ids = list(ids)
+    for i in xrange(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        cursor.execute(sql % ",".join(["%s"] * len(chunk)),
+                       list(args) + chunk)
+        for row in cursor.fetchall():
+            yield row
 
 class AgileToolsSystem(Component):
-    implements(IEnvironmentSetupParticipant)
-    
+    implements(IEnvironmentSetupParticipant, ITicketChangeListener)
+
+    position_gap = IntOption("agiletools", "position_gap", 1,
+        doc="""Spacing left between the positions of neighbouring tickets.
+        With the default of 1 positions are kept dense, so moving a ticket
+        shifts every ticket between its old and new position. A larger
+        value (e.g. 1024) leaves gaps, so that a move normally only writes
+        the moved ticket, and neighbouring tickets are only renumbered
+        locally once the gap between two tickets is used up.""")
+
+    backfill_batch_size = IntOption("agiletools", "backfill_batch_size", 500,
+        doc="""Number of tickets without an explicit position which are given
+        one per transaction by `trac-admin agiletools backfill`, and at
+        most when a ticket is dropped next to an unpositioned one. Once
+        every ticket is positioned new tickets are added at the end.""")
+
+    history_retention_days = IntOption("agiletools", "history_retention_days",
+        90, doc="""Number of days for which every ticket move is kept in the
+        position history. `trac-admin agiletools compact-history` collapses
+        older moves into one row per ticket and day. 0 keeps every move.""")
+
+    position_scope = ChoiceOption("agiletools", "position_scope",
+        ["global", "milestone"],
+        doc="""Which tickets are ranked against each other. With `global`
+        all tickets share one sequence of positions. With `milestone` each
+        milestone (and the tickets without a milestone) has its own, so
+        moving a ticket only renumbers tickets in the same milestone, and
+        a ticket moved to another milestone is put at the end of it. Run
+        `trac-admin agiletools renumber` after switching back to
+        `global`.""")
+
+    position_cache_size = IntOption("agiletools", "position_cache_size",
+        10000, doc="""Number of ticket positions kept in memory by each
+        process. Moves made in the same process update the cache, and moves
+        made by other processes are noticed through a counter in the
+        database. 0 disables the cache.""")
+
+    resource_independent_policies = ListOption("agiletools",
+        "resource_independent_policies",
+        "DefaultPermissionPolicy, LegacyAttachmentPolicy",
+        doc="""Permission policies which never grant or deny viewing a
+        ticket based on the ticket itself. When all policies in
+        `[trac] permission_policies` are listed here, the backlog and task
+        board check TICKET_VIEW once per request instead of once per
+        ticket.""")
+
+    def __init__(self):
+        self._cache = LRUCache(self.position_cache_size)
+
     # IEnvironmentSetupParticipant
     def environment_created(self):
         @self.env.with_transaction()
@@ -27,6 +127,8 @@ class AgileToolsSystem(Component):
                     cursor.execute(sql)
             cursor.execute('INSERT INTO system (name, value) VALUES (%s, %s)',
                            (db_default.name, db_default.version))
+            cursor.execute('INSERT INTO system (name, value) VALUES (%s, %s)',
+                           (db_default.generation_name, '0'))
 
     def environment_needs_upgrade(self, db):
         cursor = db.cursor()
@@ -66,59 +168,695 @@ class AgileToolsSystem(Component):
             self.log.info('Upgraded %s database version from %d to %d', 
                           db_default.name, i-1, i)
 
+    # ITicketChangeListener methods
+    def ticket_created(self, ticket):
+        # Until the backfill is complete unpositioned tickets are shown in
+        # priority order, and new tickets take their turn among them
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        if not self._backfilled(cursor, exclude=ticket.id):
+            return
+
+        def do_append(cursor):
+            cursor.execute("""
+                            SELECT position FROM ticket_positions
+                            WHERE ticket = %s""", (ticket.id, ))
+            if cursor.fetchone():
+                return None, {}
+            position = self._next_position(cursor, scope)
+            cursor.execute("""
+                            INSERT INTO ticket_positions (ticket, position)
+                            VALUES (%s, %s)""", (ticket.id, position))
+            return None, {ticket.id: position}
+
+        scope = self._scope(cursor, ticket.id)
+        self._write_positions(do_append, [scope])
+
+    def ticket_changed(self, ticket, comment, author, old_values):
+        if self.position_scope != 'milestone' or \
+                'milestone' not in old_values:
+            return
+
+        # The position ranked the ticket in its old milestone, so it would
+        # clash with the positions in the new one
+        def do_rescope(cursor):
+            cursor.execute("""
+                            SELECT position FROM ticket_positions
+                            WHERE ticket = %s""", (ticket.id, ))
+            row = cursor.fetchone()
+            if row is None:
+                return None, {}
+            new_position = self._next_position(cursor, scope)
+            cursor.execute("""
+                            UPDATE ticket_positions SET position = %s
+                            WHERE ticket = %s""", (new_position, ticket.id))
+            cursor.execute("""
+                            INSERT INTO ticket_positions_change
+                                (ticket, time, author, oldposition, newposition)
+                            VALUES (%s, %s, %s, %s, %s)""",
+                            (ticket.id, to_utimestamp(ticket['changetime']),
+                             author, row[0], new_position))
+            return None, {ticket.id: new_position}
+
+        scope = _Scope(ticket['milestone'] or '')
+        self._write_positions(do_rescope, [scope])
+
+    def ticket_deleted(self, ticket):
+        pass
+
     # own methods
-    def position(self, ticket, generate=False):
+    def viewable_tickets(self, req, results, action='TICKET_VIEW'):
+        """Return the query `results` for which the user has `action`.
+
+        When none of the permission policies look at the ticket itself,
+        `action` is checked once for all tickets, otherwise it is checked
+        for each ticket.
+        """
+        start = time.time()
+        allowed = self.permission_for_all(req, action)
+        fast = allowed is not None
+
+        if fast:
+            viewable = list(results) if allowed else []
+        else:
+            viewable = [result for result in results
+                        if action in req.perm('ticket', result['id'])]
+
+        self.log.debug("Checked %s on %d tickets %s in %.3fs",
+                       action, len(viewable),
+                       "at once" if fast else "one by one",
+                       time.time() - start)
+        return viewable
+
+    def permission_for_all(self, req, action='TICKET_VIEW'):
+        """Return whether the user has `action` on every ticket, or None when
+        the permission policies may answer differently for each ticket."""
+        policies = [policy.__class__.__name__
+                    for policy in PermissionSystem(self.env).policies]
+        if all(policy in self.resource_independent_policies
+               for policy in policies):
+            return action in req.perm
+        return None
+
+    def check_modified(self, req, milestone=None, extra=()):
+        """Send a 304 response if the client already has the current ticket
+        data for `milestone`, otherwise add an ETag header to the response.
+        `milestone` is a name or a list of names, or None for all tickets.
+
+        The entity tag covers the last change to a ticket in the milestones,
+        the number of tickets in them, the last change to ticket positions
+        and the user's permissions, plus anything in `extra` which varies
+        the response. These are hashed, so the header stays short however
+        many permissions or milestones there are.
+        """
         db = self.env.get_read_db()
         cursor = db.cursor()
-        cursor.execute("""
-                        SELECT position FROM ticket_positions
-                        WHERE ticket = %s""", (ticket, ))
+        if milestone is None:
+            cursor.execute("SELECT MAX(changetime), COUNT(*) FROM ticket")
+        else:
+            names = milestone if isinstance(milestone, list) else [milestone]
+            milestone_sql, args = milestones_sql(names)
+            cursor.execute("""
+                SELECT MAX(changetime), COUNT(*) FROM ticket
+                WHERE %s""" % milestone_sql, args)
+        changetime, count = cursor.fetchone()
+        permissions = sorted(PermissionSystem(self.env)
+                             .get_user_permissions(req.authname))
+        fingerprint = hashlib.sha1()
+        for part in [milestone, changetime, count, self._generation(cursor),
+                     permissions] + list(extra):
+            fingerprint.update(repr(part))
+        req.check_modified(from_utimestamp(changetime or 0),
+                           fingerprint.hexdigest())
 
-        position = (cursor.fetchone() or [None])[0]
+    def position(self, ticket, generate=False):
+        position = self.positions([ticket])[int(ticket)]
 
         # When we insert a ticket at a position, we often want it to be 
         # relative to another ticket. This method allows us to ensure that
-        # our relative ticket _always_ has an explicit position
+        # our relative ticket _always_ has an explicit position. Once the
+        # backfill has positioned every ticket this never has to happen, so
+        # at most one batch is positioned here and the rest is left to it.
         if generate and position is None:
+            _, position = self._backfill_batch(self.backfill_batch_size,
+                                               until=ticket)
+            if position is None:
+                # Not a ticket, or further down the unpositioned tickets
+                # than one batch, so point past the last positioned ticket
+                db = self.env.get_read_db()
+                cursor = db.cursor()
+                position = self._next_position(cursor,
+                                               self._scope(cursor, ticket))
 
-            cursor.execute("SELECT MAX(position) FROM ticket_positions")
-            last = cursor.fetchone()
-            new_position = start = last[0] + 1 if last[0] else 0
+        return position
 
-            # Find all unsorted tickets
-            cursor.execute("""
-                SELECT id,
+    def backfill(self, limit=None):
+        """Give tickets without an explicit position one, appending them
+        after all positioned tickets in the order they are currently shown
+        in (priority, then id).
+
+        Works in transactions of `backfill_batch_size` tickets, so it can
+        be interrupted and resumed at any time. At most `limit` tickets are
+        positioned when given. Returns the number of tickets positioned.
+        """
+        total = 0
+        while limit is None or total < limit:
+            batch = self.backfill_batch_size
+            if limit is not None:
+                batch = min(batch, limit - total)
+            count, _ = self._backfill_batch(batch)
+            if not count:
+                break
+            total += count
+        return total
+
+    def _backfilled(self, cursor, exclude=None):
+        """Return whether the backfill has run and left no ticket (other
+        than `exclude`) without a position."""
+        cursor.execute("SELECT MAX(position) FROM ticket_positions")
+        if cursor.fetchone()[0] is None:
+            return False
+        cursor.execute("""
+            SELECT id FROM ticket
+            LEFT OUTER JOIN ticket_positions AS positions
+                ON (positions.ticket=id)
+            WHERE positions.position IS NULL AND id != %s
+            LIMIT 1""", (exclude or 0, ))
+        return cursor.fetchone() is None
+
+    def _next_position(self, cursor=None, scope=None):
+        """Return the position following the last positioned ticket (in
+        `scope`, when given)."""
+        if cursor is None:
+            db = self.env.get_read_db()
+            cursor = db.cursor()
+        scope_sql, scope_args = (scope or _Scope()).sql()
+        cursor.execute("SELECT MAX(position) FROM ticket_positions WHERE "
+                       + scope_sql, scope_args)
+        last = cursor.fetchone()[0]
+        return last + max(self.position_gap, 1) if last is not None else 0
+
+    def _scope(self, cursor, ticket):
+        """Return the `_Scope` in which `ticket` is ranked."""
+        if self.position_scope != 'milestone':
+            return _Scope()
+        cursor.execute("SELECT milestone FROM ticket WHERE id = %s",
+                       (ticket, ))
+        row = cursor.fetchone()
+        return _Scope((row and row[0]) or '')
+
+    def _generation_name(self, scope):
+        """Return the name of the system table row counting the writes to
+        the positions in `scope`."""
+        if scope.milestone is None:
+            return db_default.generation_name
+        return "%s:%s" % (db_default.generation_name, scope.milestone)
+
+    def _generation_names(self, cursor):
+        """Return the names of the generation rows of every scope, in the
+        order they are locked in."""
+        db = self.env.get_read_db()
+        cursor.execute("SELECT name FROM system WHERE name = %s OR name "
+                       + db.like(), (db_default.generation_name,
+                                     db.like_escape(db_default.generation_name
+                                                    + ":") + "%"))
+        return sorted(name for name, in cursor)
+
+    def _generation(self, cursor):
+        """Return the current positions generation, which is the number of
+        writes made to the positions of every scope together."""
+        db = self.env.get_read_db()
+        cursor.execute("SELECT SUM(%s) FROM system WHERE name = %%s OR name "
+                       % db.cast('value', 'int') + db.like(),
+                       (db_default.generation_name,
+                        db.like_escape(db_default.generation_name + ":")
+                        + "%"))
+        row = cursor.fetchone()
+        return int(row[0]) if row and row[0] is not None else 0
+
+    def _add_generations(self, scopes):
+        """Add the missing generation rows of `scopes`, each in its own
+        transaction before any position is written."""
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        for name in set(self._generation_name(scope) for scope in scopes):
+            cursor.execute("SELECT 1 FROM system WHERE name = %s", (name, ))
+            if cursor.fetchone():
+                continue
+            try:
+                @self.env.with_transaction()
+                def do_insert(db):
+                    cursor = db.cursor()
+                    cursor.execute("INSERT INTO system (name, value) "
+                                   "VALUES (%s, '0')", (name, ))
+            except Exception:
+                # Another writer added it first
+                cursor.execute("SELECT 1 FROM system WHERE name = %s",
+                               (name, ))
+                if not cursor.fetchone():
+                    raise
+
+    def _claim_generation(self, cursor, scopes=None):
+        """Lock the positions in `scopes` (or in every scope when `None`)
+        and bump the positions generation. Returns the new generation.
+
+        This is the first statement of every transaction changing positions.
+        Each scope has its own generation row in the system table, which is
+        written without changing it first. That takes the row (or on SQLite
+        the database) write lock, so concurrent writers to the same scope
+        queue up behind it and only read positions once the previous writer
+        committed, while writers to other milestones carry on. Rows are
+        locked in name order, so writers to several scopes can't deadlock.
+        Only one row is bumped, so every write adds one to the generation.
+        """
+        if scopes is None:
+            names = self._generation_names(cursor)
+        else:
+            names = sorted(set(self._generation_name(scope)
+                               for scope in scopes))
+        for name in names:
+            cursor.execute("UPDATE system SET value = value WHERE name = %s",
+                           (name, ))
+        cursor.execute("SELECT value FROM system WHERE name = %s",
+                       (names[0], ))
+        cursor.execute("UPDATE system SET value = %s WHERE name = %s",
+                       (str(int(cursor.fetchone()[0]) + 1), names[0]))
+        return self._generation(cursor)
+
+    def _write_positions(self, fn, scopes=None):
+        """Call `fn(cursor)` in a transaction which has locked the positions
+        in `scopes` (or in every scope when `None`), see
+        `_claim_generation`.
+
+        `fn` returns a tuple of its result, which is returned, and a dict of
+        every ticket position it changed, which is used to update the
+        position cache. `None` instead of the dict empties the cache.
+        """
+        if scopes is not None:
+            self._add_generations(scopes)
+        result = []
+
+        @self.env.with_transaction()
+        def do_write(db):
+            cursor = db.cursor()
+            generation = self._claim_generation(cursor, scopes)
+            result.append((generation, fn(cursor)))
+        generation, (value, changes) = result[0]
+        self._cache.written(generation, changes)
+        return value
+
+    def _backfill_batch(self, batch, until=None):
+        """Position up to `batch` unpositioned tickets (or all of them when
+        `batch` is `None`) in one transaction, stopping early once ticket
+        `until` has been positioned. Only tickets in the scope of `until`
+        are positioned when ranking by milestone.
+
+        Returns a tuple of the number of tickets positioned and the new
+        position of `until` (or `None`).
+        """
+        def do_backfill(cursor):
+            result = [0, None]
+            if until is not None:
+                # Someone else may have positioned it since we last looked
+                cursor.execute("""
+                    SELECT position FROM ticket_positions
+                    WHERE ticket = %s""", (until, ))
+                row = cursor.fetchone()
+                if row:
+                    result[1] = row[0]
+                    return result, {}
+
+            gap = max(self.position_gap, 1)
+            if until is not None:
+                scope_sql, args = self._scope(cursor, until).sql('id')
+            else:
+                scope_sql, args = "1=1", []
+
+            # Find unsorted tickets, in the order they are currently shown
+            sql = """
+                SELECT id, milestone,
                     CAST(COALESCE(priority.value,'999') AS int) AS prio
                 FROM ticket
                 LEFT OUTER JOIN enum AS priority
                     ON (priority.type='priority' AND priority.name=priority)
                 LEFT OUTER JOIN ticket_positions AS positions
                     ON (positions.ticket=id)
-                WHERE positions.position IS NULL
-                ORDER BY prio, id""")
+                WHERE positions.position IS NULL AND %s
+                ORDER BY prio, id""" % scope_sql
+            if batch is not None:
+                sql += " LIMIT %s"
+                args = args + [batch]
+            cursor.execute(sql, args)
 
+            # Each scope carries on after its last positioned ticket
+            scoped = self.position_scope == 'milestone'
+            starts = {}
             positions = []
-
-            for i, row in enumerate(cursor):
-                positions.append((row[0], start + i))
+            for row in cursor.fetchall():
+                scope = _Scope(row[1] or '') if scoped else _Scope()
+                if scope.milestone not in starts:
+                    starts[scope.milestone] = self._next_position(cursor,
+                                                                  scope)
+                position = starts[scope.milestone]
+                starts[scope.milestone] += gap
+                positions.append((row[0], position))
 
                 # We've reached our before ticket, don't fix any more
-                if row[0] == ticket:
-                    new_position = start + i
+                if row[0] == until:
+                    result[1] = position
                     break
 
+            cursor.executemany("""
+                INSERT INTO ticket_positions (ticket, position)
+                VALUES (%s,%s)""", positions)
+            result[0] = len(positions)
+            return result, dict(positions)
+
+        scopes = None
+        if until is not None:
+            db = self.env.get_read_db()
+            scopes = [self._scope(db.cursor(), until)]
+        result = self._write_positions(do_backfill, scopes)
+        if result[0]:
+            self.log.debug("Backfilled positions for %d tickets", result[0])
+        return tuple(result)
+
+    def positions(self, tickets, chunk_size=500):
+        """Return a dict mapping each of `tickets` to its position, or to
+        `None` when it has no explicit position.
+
+        Looks the positions up with one query per `chunk_size` tickets rather
+        than one query per ticket, and only for tickets which aren't in the
+        position cache.
+        """
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        if self.position_cache_size <= 0:
+            return self._positions(cursor, tickets, chunk_size)
+
+        generation = self._generation(cursor)
+        positions, missing = self._cache.get_many(
+            set(int(t) for t in tickets), generation)
+        if missing:
+            fetched = self._positions(cursor, missing, chunk_size)
+            self._cache.set_many(fetched.iteritems(), generation)
+            positions.update(fetched)
+
+        self.log.debug("Position cache: %d hits, %d misses for this lookup, "
+                       "%d hits, %d misses in total, %d tickets cached",
+                       len(positions) - len(missing), len(missing),
+                       self._cache.hits, self._cache.misses, len(self._cache))
+        return positions
+
+    def _positions(self, cursor, tickets, chunk_size=500):
+        ids = list(set(int(t) for t in tickets))
+        positions = dict.fromkeys(ids)
+        positions.update(chunked_in(cursor, """
+                            SELECT ticket, position FROM ticket_positions
+                            WHERE ticket IN (%s)""", ids, chunk_size))
+        return positions
+
+    def renumber(self, gap=None, batch=1000):
+        """Renumber all positioned tickets to `0, gap, 2 * gap, ...` (by
+        default using `position_gap`), keeping their order.
+
+        Tickets are first moved, in order and in transactions of `batch`
+        tickets, to positions below the current lowest position, and then
+        shifted up into place from the last ticket backwards. The order of
+        the tickets is therefore the same at every point, even if the
+        renumbering is interrupted. Returns the number of tickets renumbered.
+        """
+        if gap is None:
+            gap = self.position_gap
+        gap = max(gap, 1)
+
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT COUNT(*), MIN(position) FROM ticket_positions")
+        count, lowest = cursor.fetchone()
+        if not count:
+            return 0
+        # Moved below every current position and below 0, so the tickets
+        # moved up into place later stay after those still waiting
+        offset = (count - 1) * gap - min(lowest, 0) + 1
+
+        tickets = []
+        fetched = [batch]
+        while fetched[0] == batch and len(tickets) < count:
+            def do_move_below(cursor):
+                cursor.execute("""
+                    SELECT ticket FROM ticket_positions
+                    WHERE position >= %s
+                    ORDER BY position, ticket LIMIT %s""", (lowest, batch))
+                rows = [row[0] for row in cursor.fetchall()]
+                fetched[0] = len(rows)
+                cursor.executemany("""
+                    UPDATE ticket_positions SET position = %s
+                    WHERE ticket = %s""",
+                    [((len(tickets) + i) * gap - offset, ticket)
+                     for i, ticket in enumerate(rows)])
+                tickets.extend(rows)
+                return None, None
+            self._write_positions(do_move_below)
+
+        for end in xrange(len(tickets), 0, -batch):
+            def do_move_up(cursor):
+                cursor.executemany("""
+                    UPDATE ticket_positions SET position = %s
+                    WHERE ticket = %s""",
+                    [(i * gap, tickets[i])
+                     for i in xrange(max(end - batch, 0), end)])
+                return None, None
+            self._write_positions(do_move_up)
+
+        self.log.info("Renumbered %d ticket positions with a gap of %d",
+                      len(tickets), gap)
+        return len(tickets)
+
+    def position_history(self, ticket):
+        """Return the moves of `ticket` as a list of `(time, author,
+        oldposition, newposition)` tuples, oldest first."""
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        # Served by the table's (ticket, time) key
+        cursor.execute("""
+                        SELECT time, author, oldposition, newposition
+                        FROM ticket_positions_change
+                        WHERE ticket = %s ORDER BY time""", (ticket, ))
+        return [(from_utimestamp(time), author, _as_int(old), _as_int(new))
+                for time, author, old, new in cursor]
+
+    def moves_since(self, when):
+        """Return all moves after `when` as a list of `(ticket, time, author,
+        oldposition, newposition)` tuples, oldest first."""
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("""
+                        SELECT ticket, time, author, oldposition, newposition
+                        FROM ticket_positions_change
+                        WHERE time > %s ORDER BY time""",
+                        (to_utimestamp(when), ))
+        return [(ticket, from_utimestamp(time), author, _as_int(old),
+                 _as_int(new))
+                for ticket, time, author, old, new in cursor]
+
+    def positions_if_moved(self, milestone, start, end):
+        """Return a dict of the current positions of the tickets in
+        `milestone` whose position may have changed between `start` and
+        `end`.
+
+        Only the moved tickets are logged in the position history, not the
+        tickets shifted to make room for them. With dense positions those
+        lie between the old and new position of a move, so the tickets in
+        those ranges are returned. With gaps between the positions only
+        the tickets renumbered to open a gap move along, and they are
+        logged as well, so only the logged tickets are returned.
+        """
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        scope_sql, scope_args = _Scope(milestone).sql()
+        period = [to_utimestamp(start), to_utimestamp(end)]
+
+        if self.position_gap > 1:
+            # Served by the index on time
+            cursor.execute("""
+                SELECT ticket, position FROM ticket_positions
+                WHERE ticket IN (SELECT ticket FROM ticket_positions_change
+                                 WHERE time >= %%s AND time <= %%s)
+                AND %s""" % scope_sql, period + scope_args)
+            return dict(cursor)
+
+        # A move shifts the tickets ranked against it, which are those in
+        # other milestones too unless ranking by milestone
+        if self.position_scope == 'milestone':
+            ranked_sql, ranked_args = scope_sql, scope_args
+        else:
+            ranked_sql, ranked_args = "1=1", []
+        cursor.execute("""
+                        SELECT oldposition, newposition
+                        FROM ticket_positions_change
+                        WHERE time >= %%s AND time <= %%s AND %s"""
+                        % ranked_sql, period + ranked_args)
+        ranges = []
+        for old, new in cursor.fetchall():
+            old, new = _as_int(old), _as_int(new)
+            if old is None:
+                # Everything after a newly positioned ticket shifts
+                ranges.append((new, None))
+            else:
+                ranges.append((min(old, new), max(old, new)))
+        if not ranges:
+            return {}
+
+        # Overlapping ranges are merged, keeping the query short
+        merged = []
+        for low, high in sorted(ranges):
+            if not merged or merged[-1][1] is not None \
+                    and low > merged[-1][1] + 1:
+                merged.append([low, high])
+            elif merged[-1][1] is not None:
+                merged[-1][1] = high if high is None \
+                                else max(merged[-1][1], high)
+
+        ranges_sql = []
+        args = []
+        for low, high in merged:
+            if high is None:
+                ranges_sql.append("position >= %s")
+                args.append(low)
+            else:
+                ranges_sql.append("position BETWEEN %s AND %s")
+                args.extend([low, high])
+        cursor.execute("""
+                        SELECT ticket, position FROM ticket_positions
+                        WHERE (%s) AND %s"""
+                        % (" OR ".join(ranges_sql), scope_sql),
+                        args + scope_args)
+        return dict(cursor)
+
+    def other_changes(self, req, scope_ids, start, end):
+        """Return the sorted ids of the tickets changed between `start`
+        (inclusive) and `end` which aren't in `scope_ids` and which the user
+        may view.
+
+        These are the tickets which may have left the scope of a view
+        updated with the tickets changed in that period, e.g. by moving to
+        another milestone or being closed.
+        """
+        scope_ids = set(scope_ids)
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT id FROM ticket WHERE changetime>=%s AND changetime<%s
+            """, (to_utimestamp(start), to_utimestamp(end)))
+        other_ids = sorted(id_ for id_, in cursor if id_ not in scope_ids)
+
+        allowed = self.permission_for_all(req)
+        if allowed is None:
+            return [id_ for id_ in other_ids
+                    if 'TICKET_VIEW' in req.perm('ticket', id_)]
+        return other_ids if allowed else []
+
+    def compact_history(self, before=None, max_days=None):
+        """Collapse the moves made before `before` (by default
+        `history_retention_days` ago) into a single row per ticket and day,
+        going from the oldest moves not yet compacted up to `before`.
+
+        Every day is compacted in its own transaction, and the day reached
+        is remembered so that an interrupted run picks up where it left
+        off. At most `max_days` days are compacted when given. Returns the
+        number of rows removed.
+        """
+        if before is None:
+            if not self.history_retention_days:
+                return 0
+            before = datetime.now(utc) - \
+                timedelta(days=self.history_retention_days)
+        before_ts = to_utimestamp(before)
+        day = 86400 * 1000000
+
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT value FROM system WHERE name = %s",
+                       (db_default.history_compacted_name, ))
+        row = cursor.fetchone()
+        start = int(row[0]) if row else 0
+
+        removed = [0]
+        days = 0
+        while max_days is None or days < max_days:
+            # Skip straight to the next day with any moves
+            cursor.execute("""
+                SELECT MIN(time) FROM ticket_positions_change
+                WHERE time >= %s""", (start, ))
+            next_move = cursor.fetchone()[0]
+            if next_move is None:
+                break
+            start = next_move - next_move % day
+            if start + day > before_ts:
+                break
+
             @self.env.with_transaction()
-            def do_set_ticket_position(db):
+            def do_compact(db):
                 cursor = db.cursor()
+                cursor.execute("""
+                    SELECT ticket, time, author, oldposition, newposition
+                    FROM ticket_positions_change
+                    WHERE time >= %s AND time < %s
+                    ORDER BY ticket, time""", (start, start + day))
+
+                moves = defaultdict(list)
+                for row in cursor.fetchall():
+                    moves[row[0]].append(row)
+
+                summaries = []
+                for ticket, rows in moves.iteritems():
+                    if len(rows) > 1:
+                        # Keep the last move, but from the day's first position
+                        first, last = rows[0], rows[-1]
+                        summaries.append((ticket, last[1], last[2],
+                                          first[3], last[4]))
+                        cursor.execute("""
+                            DELETE FROM ticket_positions_change
+                            WHERE ticket = %s AND time >= %s AND time < %s""",
+                            (ticket, start, start + day))
+                        removed[0] += len(rows)
+
                 cursor.executemany("""
-                    INSERT INTO ticket_positions (ticket, position)
-                    VALUES (%s,%s)""", positions)
+                    INSERT INTO ticket_positions_change
+                        (ticket, time, author, oldposition, newposition)
+                    VALUES (%s, %s, %s, %s, %s)""", summaries)
+                removed[0] -= len(summaries)
 
-            return new_position
+                cursor.execute("SELECT value FROM system WHERE name = %s",
+                               (db_default.history_compacted_name, ))
+                if cursor.fetchone():
+                    cursor.execute("UPDATE system SET value = %s "
+                                   "WHERE name = %s",
+                                   (str(start + day),
+                                    db_default.history_compacted_name))
+                else:
+                    cursor.execute("INSERT INTO system (name, value) "
+                                   "VALUES (%s, %s)",
+                                   (db_default.history_compacted_name,
+                                    str(start + day)))
 
-        return position
+            start += day
+            days += 1
+
+        self.log.info("Compacted %d days of position history, removing %d "
+                      "rows", days, removed[0])
+        return removed[0]
 
     def move(self, ticket, position, author=None, when=None):
+        """Move `ticket` to `position`, placing it immediately before the
+        ticket currently holding that position (if any).
+
+        When `position_gap` is larger than 1 the ticket is slotted into the
+        gap in front of that ticket instead of shifting all tickets in
+        between, see `_place_in_gap`. When ranking by milestone only the
+        tickets in the ticket's milestone are taken into account.
+        """
         self.log.debug("Moving ticket %d to position %d",
                        ticket, position)
 
@@ -126,58 +864,527 @@ class AgileToolsSystem(Component):
             when = datetime.now(utc)
         when_ts = to_utimestamp(when)
 
-        old_position = self.position(ticket)
-        old_is_set = old_position is not None
-
-        if position == old_position:
+        # Cheap check before taking the write lock, repeated below
+        if self.position(ticket) == position:
             return
 
-        @self.env.with_transaction()
-        def do_move(db):
+        def do_move(cursor):
+            # Read the current position in the same transaction which moves
+            # the ticket, so the shift isn't based on a stale position
+            cursor.execute("""
+                            SELECT position FROM ticket_positions
+                            WHERE ticket = %s""", (ticket, ))
+            old_position = (cursor.fetchone() or [None])[0]
 
-            cursor = db.cursor()
+            if position == old_position:
+                return None, {}
 
-            # If we're moving a ticket is moving down then we handle it
-            # differently. In particular we decrement the position by one
-            # as all tickets get shifted up one when it's moved from it's old
-            # position
-            moving_up = not old_is_set or position < old_position
-            new_position = position if moving_up else position - 1
+            if self.position_gap > 1:
+                changes = {}
+                renumbered = {}
+                new_position = self._place_in_gap(cursor, ticket, position,
+                                                  old_position, scope,
+                                                  changes, renumbered)
+                changes[ticket] = new_position
+                self._log_renumbered(cursor, renumbered, [ticket], when_ts,
+                                     author)
+            else:
+                # Too many tickets shift to keep track of
+                changes = None
+                new_position = self._shift_into(cursor, ticket, position,
+                                                old_position, scope)
 
-            if old_is_set:
-                cursor.execute("""
-                                DELETE FROM ticket_positions
-                                WHERE ticket = %s""", (ticket, ))
+            # Log the move
+            cursor.execute("""
+                            INSERT INTO ticket_positions_change
+                                (ticket, time, author, oldposition, newposition)
+                            VALUES (%s, %s, %s, %s, %s)""",
+                            (ticket, when_ts, author, old_position, new_position))
+            return None, changes
 
-            if moving_up:
+        db = self.env.get_read_db()
+        scope = self._scope(db.cursor(), ticket)
+        self._write_positions(do_move, [scope])
 
-                if old_is_set:
-                    cursor.execute("""
-                                    UPDATE ticket_positions
-                                    SET position = position + 1
-                                    WHERE position BETWEEN %s and %s""",
-                                    (position, old_position))
-                else:
-                    cursor.execute("""
-                                    UPDATE ticket_positions
-                                    SET position = position + 1
-                                    WHERE position >= %s""",
-                                    (position, ))
+    def _shift_into(self, cursor, ticket, position, old_position, scope):
+        """Dense positioning: shift every ticket in `scope` between the old
+        and the new position by one to make room for `ticket`."""
+        old_is_set = old_position is not None
+        scope_sql, scope_args = scope.sql()
+
+        # If we're moving a ticket is moving down then we handle it
+        # differently. In particular we decrement the position by one
+        # as all tickets get shifted up one when it's moved from it's old
+        # position
+        moving_up = not old_is_set or position < old_position
+        new_position = position if moving_up else position - 1
+
+        if old_is_set:
+            cursor.execute("""
+                            DELETE FROM ticket_positions
+                            WHERE ticket = %s""", (ticket, ))
+
+        if moving_up:
 
+            if old_is_set:
+                cursor.execute("""
+                                UPDATE ticket_positions
+                                SET position = position + 1
+                                WHERE position BETWEEN %s and %s
+                                AND """ + scope_sql,
+                                [position, old_position] + scope_args)
             else:
                 cursor.execute("""
                                 UPDATE ticket_positions
-                                SET position = position - 1
-                                WHERE position BETWEEN %s and %s""",
-                                (old_position, new_position))
+                                SET position = position + 1
+                                WHERE position >= %s AND """ + scope_sql,
+                                [position] + scope_args)
+
+        else:
+            cursor.execute("""
+                            UPDATE ticket_positions
+                            SET position = position - 1
+                            WHERE position BETWEEN %s and %s
+                            AND """ + scope_sql,
+                            [old_position, new_position] + scope_args)
+
+        cursor.execute("""
+                        INSERT INTO ticket_positions (ticket, position)
+                        VALUES (%s,%s)""", (ticket, new_position))
+
+        return new_position
 
+    def _place_in_gap(self, cursor, ticket, position, old_position, scope,
+                      changes=None, renumbered=None):
+        """Sparse positioning: put `ticket` half way between the ticket at
+        `position` and the one before it in `scope`, only touching other
+        rows when there is no gap left between the two. Other tickets which
+        are renumbered are added to the `changes` and `renumbered` dicts, as
+        `_open_gap` does."""
+        gap = self.position_gap
+        scope_sql, scope_args = scope.sql()
+
+        cursor.execute("""
+                        SELECT ticket FROM ticket_positions
+                        WHERE position = %s AND ticket != %s
+                        AND """ + scope_sql,
+                        [position, ticket] + scope_args)
+
+        if cursor.fetchone() is None:
+            # Nothing to go in front of, so the position is free. Take the
+            # middle of the space around it, so that the next ticket dropped
+            # in the same place still finds a gap.
+            cursor.execute("""
+                            SELECT MAX(position) FROM ticket_positions
+                            WHERE position < %s AND ticket != %s
+                            AND """ + scope_sql,
+                            [position, ticket] + scope_args)
+            before = cursor.fetchone()[0]
+            cursor.execute("""
+                            SELECT MIN(position) FROM ticket_positions
+                            WHERE position > %s AND ticket != %s
+                            AND """ + scope_sql,
+                            [position, ticket] + scope_args)
+            after = cursor.fetchone()[0]
+
+            if before is not None and after is not None:
+                new_position = (before + after) // 2
+            elif before is not None:
+                new_position = max(position, before + gap)
+            elif after is not None:
+                new_position = min(position, after - gap)
+            else:
+                new_position = position
+        else:
+            cursor.execute("""
+                            SELECT MAX(position) FROM ticket_positions
+                            WHERE position < %s AND ticket != %s
+                            AND """ + scope_sql,
+                            [position, ticket] + scope_args)
+            before = cursor.fetchone()[0]
+
+            if before is None:
+                new_position = position - gap
+            else:
+                after = position
+                if after - before < 2:
+                    after = self._open_gap(cursor, [ticket], position, scope,
+                                           changes=changes,
+                                           renumbered=renumbered)
+                new_position = (before + after) // 2
+
+        if old_position is None:
             cursor.execute("""
                             INSERT INTO ticket_positions (ticket, position)
                             VALUES (%s,%s)""", (ticket, new_position))
+        else:
+            cursor.execute("""
+                            UPDATE ticket_positions SET position = %s
+                            WHERE ticket = %s""", (new_position, ticket))
 
-            # Log the move
+        return new_position
+
+    def _open_gap(self, cursor, exclude, position, scope, room=1, batch=100,
+                  changes=None, renumbered=None):
+        """Move the tickets in `scope` from `position` onwards which are
+        packed too tightly out of the way, so that `room` gaps are free in
+        front of the first of them. Tickets in `exclude` are left alone, the
+        new positions of the others are added to the `changes` dict and
+        their old positions to the `renumbered` dict when given.
+
+        The run to move ends at the first ticket lying beyond the position
+        the run would reach if packed densely behind its new start. The run
+        is spread evenly up to that ticket, so only a few tickets are
+        written when the tickets around are still spaced out. Returns the
+        new position of the first ticket in the run.
+        """
+        gap = self.position_gap
+        start = position + room * gap
+        last = start - 1
+        run = []
+        boundary = None
+        not_in = ",".join(["%s"] * len(exclude))
+        scope_sql, scope_args = scope.sql()
+
+        # Page through the tickets by (position, ticket), so that many
+        # tickets sharing a position can't hold up the paging
+        def fetch(where, args):
             cursor.execute("""
-                            INSERT INTO ticket_positions_change
-                                (ticket, time, author, oldposition, newposition)
-                            VALUES (%s, %s, %s, %s, %s)""",
-                            (ticket, when_ts, author, old_position, new_position))
\ No newline at end of file
+                            SELECT ticket, position FROM ticket_positions
+                            WHERE %s AND ticket NOT IN (%s) AND %s
+                            ORDER BY position, ticket LIMIT %%s"""
+                            % (where, not_in, scope_sql),
+                            args + list(exclude) + scope_args + [batch])
+
+        fetch("position >= %s", [position])
+        while True:
+            rows = cursor.fetchall()
+            for tkt, pos in rows:
+                if pos > last:
+                    boundary = pos
+                    break
+                run.append(tkt)
+                if renumbered is not None:
+                    renumbered.setdefault(tkt, pos)
+                last += 1
+            if boundary is not None or len(rows) < batch:
+                break
+            tkt, pos = rows[-1]
+            fetch("(position > %s OR (position = %s AND ticket > %s))",
+                  [pos, pos, tkt])
+
+        if boundary is None:
+            step = gap
+        else:
+            step = max((boundary - start) // max(len(run), 1), 1)
+        updates = [(start + i * step, tkt) for i, tkt in enumerate(run)]
+
+        self.log.debug("Renumbered %d tickets from position %d to make room "
+                       "for %d tickets", len(updates), position, room)
+        cursor.executemany("""
+                            UPDATE ticket_positions SET position = %s
+                            WHERE ticket = %s""", updates)
+        if changes is not None:
+            changes.update((tkt, pos) for pos, tkt in updates)
+
+        return start
+
+    def _log_renumbered(self, cursor, renumbered, moved, when_ts, author):
+        """Log the tickets in the `renumbered` dict, mapping them to their
+        old positions, as moved along with the tickets in `moved`, so that
+        clients learn about their new positions too."""
+        tickets = [tkt for tkt in renumbered if tkt not in moved]
+        positions = self._positions(cursor, tickets)
+        cursor.executemany("""
+            INSERT INTO ticket_positions_change
+                (ticket, time, author, oldposition, newposition)
+            VALUES (%s, %s, %s, %s, %s)""",
+            [(tkt, when_ts, author, renumbered[tkt], positions[tkt])
+             for tkt in tickets if positions[tkt] != renumbered[tkt]])
+
+    def move_many(self, moves, author=None, when=None):
+        """Move several tickets in one transaction.
+
+        `moves` is a list of `(ticket, position)` tuples. Each position is
+        taken against the ordering before any of the moves: the ticket is
+        placed immediately before the first ticket at or after that position
+        which isn't being moved itself. Tickets placed in front of the same
+        ticket keep the order they are given in.
+
+        Rather than shifting the tickets in between once per moved ticket,
+        the final ordering is worked out up front and written in one pass.
+        When ranking by milestone the positions are taken within each
+        ticket's own milestone.
+        """
+        if when is None:
+            when = datetime.now(utc)
+        when_ts = to_utimestamp(when)
+
+        # A ticket moved more than once only ends up in its last place
+        targets = OrderedDict()
+        for ticket, position in moves:
+            targets.pop(int(ticket), None)
+            targets[int(ticket)] = position
+
+        if not targets:
+            return
+
+        self.log.debug("Moving %d tickets", len(targets))
+
+        def do_move_many(cursor):
+            tickets = targets.keys()
+            old_positions = self._positions(cursor, tickets)
+            not_in = ",".join(["%s"] * len(tickets))
+
+            new_positions = {}
+            renumbered = {}
+            for scope, scope_tickets in scopes.itervalues():
+                scope_sql, scope_args = scope.sql()
+
+                # Find the ticket each group of moved tickets goes in front of
+                anchors = {}
+                for ticket in scope_tickets:
+                    position = targets[ticket]
+                    if position in anchors:
+                        continue
+                    cursor.execute("""
+                                SELECT ticket, position FROM ticket_positions
+                                WHERE position >= %%s AND ticket NOT IN (%s)
+                                AND %s
+                                ORDER BY position LIMIT 1"""
+                                % (not_in, scope_sql),
+                                [position] + tickets + scope_args)
+                    anchors[position] = cursor.fetchone()
+
+                groups = OrderedDict()
+                for ticket in scope_tickets:
+                    groups.setdefault(anchors[targets[ticket]], []) \
+                        .append(ticket)
+
+                scope_positions = dict((ticket, old_positions[ticket])
+                                       for ticket in scope_tickets)
+                if self.position_gap > 1:
+                    new_positions.update(self._place_groups_in_gaps(
+                        cursor, groups, scope_positions, scope, renumbered))
+                else:
+                    new_positions.update(self._shift_groups_into(
+                        cursor, groups, scope_positions, scope))
+
+            # Log the moves
+            cursor.executemany("""
+                INSERT INTO ticket_positions_change
+                    (ticket, time, author, oldposition, newposition)
+                VALUES (%s, %s, %s, %s, %s)""",
+                [(ticket, when_ts, author, old_positions[ticket],
+                  new_positions[ticket])
+                 for ticket in tickets
+                 if old_positions[ticket] != new_positions[ticket]])
+            self._log_renumbered(cursor, renumbered, new_positions, when_ts,
+                                 author)
+            return None, None
+
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        scopes = OrderedDict()
+        for ticket in targets:
+            scope = self._scope(cursor, ticket)
+            scopes.setdefault(scope.milestone, (scope, []))[1].append(ticket)
+        self._write_positions(do_move_many,
+                              [scope for scope, _ in scopes.itervalues()])
+
+    def _shift_groups_into(self, cursor, groups, old_positions, scope):
+        """Dense positioning for `move_many`.
+
+        A ticket which isn't moved shifts down by the number of moved tickets
+        inserted in front of it, and up by the number of moved tickets which
+        were taken out in front of it. That is worked out in memory for the
+        tickets between the first and last affected position, and done with
+        a single UPDATE for the tickets after them. Only tickets in `scope`
+        are shifted.
+        """
+        scope_sql, scope_args = scope.sql()
+        removed = sorted(p for p in old_positions.itervalues()
+                         if p is not None)
+        inserted = sorted((anchor[1], len(group))
+                          for anchor, group in groups.iteritems()
+                          if anchor is not None)
+
+        inserted_at = [p for p, _ in inserted]
+        inserted_upto = []
+        total = 0
+        for _, count in inserted:
+            total += count
+            inserted_upto.append(total)
+
+        def shifted(position):
+            ins = bisect_right(inserted_at, position)
+            return (position
+                    + (inserted_upto[ins - 1] if ins else 0)
+                    - bisect_left(removed, position))
+
+        moved = set(old_positions)
+        events = removed + inserted_at
+        updates = []
+
+        if events:
+            first, last = min(events), max(events)
+
+            cursor.execute("""
+                            SELECT ticket, position FROM ticket_positions
+                            WHERE position BETWEEN %s AND %s
+                            AND """ + scope_sql,
+                            [first, last] + scope_args)
+            for ticket, position in cursor.fetchall():
+                if ticket not in moved and shifted(position) != position:
+                    updates.append((shifted(position), ticket))
+
+            tail = shifted(last + 1) - (last + 1)
+            if tail:
+                cursor.execute("""
+                                UPDATE ticket_positions
+                                SET position = position + %s
+                                WHERE position > %s AND """ + scope_sql,
+                                [tail, last] + scope_args)
+
+        cursor.executemany("""
+                            UPDATE ticket_positions SET position = %s
+                            WHERE ticket = %s""", updates)
+        cursor.execute("""
+                        DELETE FROM ticket_positions
+                        WHERE ticket IN (%s)""" % ",".join(["%s"] * len(moved)),
+                        list(moved))
+
+        new_positions = {}
+        for anchor, group in groups.iteritems():
+            if anchor is None:
+                start = self._next_position(cursor, scope)
+            else:
+                start = shifted(anchor[1]) - len(group)
+            for i, ticket in enumerate(group):
+                new_positions[ticket] = start + i
+
+            cursor.executemany("""
+                INSERT INTO ticket_positions (ticket, position)
+                VALUES (%s,%s)""", [(ticket, new_positions[ticket])
+                                    for ticket in group])
+
+        return new_positions
+
+    def _place_groups_in_gaps(self, cursor, groups, old_positions, scope,
+                              renumbered=None):
+        """Sparse positioning for `move_many`.
+
+        Each group is spread over the gap in front of its ticket, opening up
+        the gap first when it is too small. Groups are placed from the bottom
+        up so that opening a gap never disturbs a group already placed.
+        Only tickets in `scope` are taken into account. Other tickets which
+        are renumbered are added to the `renumbered` dict, as `_open_gap`
+        does.
+        """
+        gap = self.position_gap
+        scope_sql, scope_args = scope.sql()
+        unplaced = set(old_positions)
+        new_positions = {}
+
+        def bottom_up(anchor):
+            return (anchor is None, anchor and anchor[1])
+
+        for anchor in sorted(groups, key=bottom_up, reverse=True):
+            group = groups[anchor]
+            not_in = ",".join(["%s"] * len(unplaced))
+
+            if anchor is None:
+                cursor.execute("""
+                                SELECT MAX(position) FROM ticket_positions
+                                WHERE ticket NOT IN (%s) AND %s"""
+                                % (not_in, scope_sql),
+                                list(unplaced) + scope_args)
+                last = cursor.fetchone()[0]
+                start = last + gap if last is not None else 0
+                places = [start + i * gap for i in range(len(group))]
+            else:
+                cursor.execute("""
+                                SELECT MAX(position) FROM ticket_positions
+                                WHERE position < %%s AND ticket NOT IN (%s)
+                                AND %s""" % (not_in, scope_sql),
+                                [anchor[1]] + list(unplaced) + scope_args)
+                before = cursor.fetchone()[0]
+
+                if before is None:
+                    places = [anchor[1] - gap * (len(group) - i)
+                              for i in range(len(group))]
+                else:
+                    after = anchor[1]
+                    if after - before <= len(group):
+                        after = self._open_gap(cursor, list(unplaced),
+                                               anchor[1], scope, len(group),
+                                               renumbered=renumbered)
+                    step = (after - before) // (len(group) + 1)
+                    places = [before + step * (i + 1)
+                              for i in range(len(group))]
+
+            for ticket, position in zip(group, places):
+                if old_positions[ticket] is None:
+                    cursor.execute("""
+                        INSERT INTO ticket_positions (ticket, position)
+                        VALUES (%s,%s)""", (ticket, position))
+                else:
+                    cursor.execute("""
+                        UPDATE ticket_positions SET position = %s
+                        WHERE ticket = %s""", (position, ticket))
+                new_positions[ticket] = position
+                unplaced.discard(ticket)
+
+        return new_positions
+
+
+def _as_int(value):
+    """Positions in the history table are stored as text."""
+    return int(value) if value is not None else None
+
+def to_columns(data, depth=0):
+    """Return ticket data in the compact format clients ask for with
+    `format=columns`.
+
+    `data` is either a list of dicts, or dicts nested `depth` levels deep
+    whose innermost dicts map keys (ticket ids) to dicts. The dicts are
+    sent as rows of values under a single list of column names, and the
+    nesting as lists of row numbers, so that `{'new': {1: {'summary': 'a'}}}`
+    with a depth of 1 becomes::
+
+        {'columns': ['summary'], 'rows': [['a']], 'keys': [1],
+         'groups': {'new': [0]}}
+    """
+    items = []
+
+    def walk(node, level):
+        if level == depth:
+            start = len(items)
+            items.extend(node.iteritems())
+            return range(start, len(items))
+        return dict((key, walk(value, level + 1))
+                    for key, value in node.iteritems())
+
+    if isinstance(data, list):
+        items.extend((None, item) for item in data)
+        groups = None
+    else:
+        groups = walk(data, 0)
+
+    columns = []
+    seen = set()
+    for key, item in items:
+        for column in item:
+            if column not in seen:
+                seen.add(column)
+                columns.append(column)
+
+    compact = {
+        'columns': columns,
+        'rows': [[item.get(column) for column in columns]
+                 for key, item in items],
+        }
+    if groups is not None:
+        compact['keys'] = [key for key, item in items]
+        compact['groups'] = groups
+    return compact
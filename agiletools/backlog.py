@@ -1,4 +1,8 @@
-from agiletools.api import AgileToolsSystem
+from agiletools.api import (AgileToolsSystem, chunked_in, milestones_sql,
+                            to_columns)
+from agiletools.milestones import MilestoneCatalogue
+from agiletools.users import UserDirectory
+from agiletools.workflows import WorkflowCatalogue
 
 from trac.core import Component, implements, TracError
 from trac.db.api import with_transaction
@@ -7,15 +11,15 @@ from trac.web import IRequestHandler, IRequestFilter
 from trac.web.chrome import (ITemplateProvider, add_script, add_stylesheet,
                              add_script_data)
 from trac.ticket.query import Query
-from trac.ticket.model import Ticket, Milestone
+from trac.ticket.api import TicketSystem
+from trac.ticket.model import Ticket
 from trac.ticket.web_ui import TicketModule
 from trac.util.presentation import to_json
+from trac.util.text import empty
 from pkg_resources import resource_filename
 from datetime import datetime
-from trac.util.datefmt import to_utimestamp, utc
-from trac.web.session import DetachedSession
-
-from logicaordertracker.controller import LogicaOrderController
+from trac.util.datefmt import (from_utimestamp, parse_date, to_utimestamp,
+                                utc)
 
 class BacklogModule(Component):
     implements(IRequestHandler, ITemplateProvider, IRequestFilter)
@@ -80,6 +84,28 @@ class BacklogModule(Component):
 
                     return self._json_send(req, response)
 
+                # Reordering multiple tickets relative to another ticket
+                elif all (k in req.args for k in ("tickets", "relative")) \
+                        and "milestone" not in req.args:
+                    try:
+                        ids = [int(tkt_id) for tkt_id in req.args["tickets"].split(",")]
+                        int_relative = int(str_relative)
+                    except (ValueError, TypeError):
+                        return self._json_errors(req, ["Invalid arguments"])
+
+                    missing = self._missing_tickets(ids + [int_relative])
+                    if missing:
+                        return self._json_errors(req, ["Not a valid ticket: %s"
+                            % ", ".join(str(i) for i in missing)])
+
+                    position = ats.position(int_relative, generate=True)
+                    if direction == "after":
+                        position += 1
+
+                    ats.move_many([(int_ticket, position) for int_ticket in ids],
+                                  author=req.authname)
+                    return self._json_send(req, {'success': True})
+
                 # Dropping multiple tickets into a milestone
                 elif all (k in req.args for k in ("tickets", "milestone", "changetimes")):
 
@@ -91,30 +117,11 @@ class BacklogModule(Component):
                     except (ValueError, TypeError):
                         return self._json_errors(req, ["Invalid arguments"])
 
-                    unique_errors = 0
-                    errors_by_ticket = []
-                    # List of [<ticket_id>, [<error>, ...]] lists
                     if len(ids) == len(changetimes):
-                        for i, int_ticket in enumerate(ids):
-                            # Valid ticket
-                            try:
-                                ticket = Ticket(self.env, int_ticket)
-                            except ResourceNotFound:
-                                errors_by_ticket.append([int_ticket, ["Not a valid ticket"]])
-                            # Can be saved
-                            try:
-                                self._save_ticket(req, ticket, milestone, ts=changetimes[i])
-                            except ValueError as e:
-                                # Quirk: all errors amalgomated into single
-                                # we keep track of count at each time so that
-                                # we can split the list up to errors by
-                                # individual tickets
-                                errors_by_ticket.append([int_ticket, e.message[unique_errors:]])
-                                unique_errors = len(e.message)
-                                if len(errors_by_ticket) > 5:
-                                    errors_by_ticket.append("More than 5 tickets failed "
-                                                            "validation, stopping.")
-                                    break
+                        # List of [<ticket_id>, [<error>, ...]] lists
+                        errors_by_ticket = self._save_tickets(req, ids,
+                                                              milestone,
+                                                              changetimes)
                         if errors_by_ticket:
                             return self._json_errors(req, errors_by_ticket)
                         else:
@@ -126,20 +133,77 @@ class BacklogModule(Component):
                 else:
                     return self._json_errors(req, ["Must provide a ticket"])
             else:
-                # TODO make client side compatible with live updates
+                # A single milestone, or several at once with "milestones"
                 milestone = req.args.get("milestone")
+                names = req.args.getlist("milestones")
+                if not names and milestone is not None:
+                    names = [milestone]
                 from_iso = req.args.get("from")
                 to_iso = req.args.get("to")
+                columns = req.args.get("format") == "columns"
 
-                if milestone is not None:
+                try:
+                    offset = int(req.args.get("offset", 0))
+                    limit = req.args.get("limit")
+                    limit = int(limit) if limit is not None else None
+                except (TypeError, ValueError):
+                    return self._json_errors(req, ["Invalid arguments"])
+
+                if names and offset >= 0 and (limit is None or limit >= 0):
                     # Requesting an update
-                    constr = { 'milestone': [milestone] }
+                    constr = { 'milestone': names }
                     if from_iso and to_iso:
                         constr['changetime'] = [from_iso + ".." + to_iso]
-
-                    tickets = self._get_permitted_tickets(req, constraints=constr)
-                    formatted = self._get_ticket_data(req, tickets)
-                    self._json_send(req, {'tickets': formatted})
+                    else:
+                        ats.check_modified(req, names, [offset, limit, columns,
+                            sorted(self._get_closed_statuses().items())])
+
+                    if limit == 0 and not constr.get('changetime'):
+                        # Only the totals, without loading any tickets
+                        totals = self._get_milestone_totals(req, names)
+                        responses = dict((name, {'total': totals[name]['tickets'],
+                                                 'totals': totals[name]})
+                                         for name in names)
+                    elif limit is not None and not constr.get('changetime') \
+                            and ats.permission_for_all(req) is not None:
+                        # The user sees all of the tickets or none, so only
+                        # read the window asked for, and count the rest in
+                        # one grouped query
+                        totals = self._get_milestone_totals(req, names)
+                        responses = dict((name, self._get_milestone_data(req, name,
+                                            self._get_permitted_tickets(req,
+                                                {'milestone': [name]}, offset, limit),
+                                            columns=columns, offset=offset,
+                                            totals=totals[name]))
+                                         for name in names)
+                    else:
+                        # One query for every milestone, split up here
+                        by_milestone = dict((name, []) for name in names)
+                        results = self._get_permitted_tickets(req, constraints=constr)
+                        for ticket in results:
+                            by_milestone.setdefault(ticket['milestone'] or '', []).append(ticket)
+
+                        responses = {}
+                        for name in names:
+                            tickets = by_milestone[name]
+                            if limit is not None and not constr.get('changetime'):
+                                responses[name] = self._get_milestone_data(req,
+                                    name, tickets[offset:offset + limit],
+                                    columns=columns, offset=offset,
+                                    totals=self._get_totals(tickets))
+                            else:
+                                responses[name] = self._get_milestone_data(req,
+                                    name, tickets, from_iso, to_iso, columns)
+                    if "milestones" in req.args:
+                        response = {'milestones': responses}
+                    else:
+                        response = responses[milestone]
+                    if constr.get('changetime'):
+                        # Tickets which left the milestones or were closed
+                        response['otherChanges'] = ats.other_changes(req,
+                            (ticket['id'] for ticket in results),
+                            parse_date(from_iso, utc), parse_date(to_iso, utc))
+                    self._json_send(req, response)
                 else:
                     self._json_errors(req, ["Invalid arguments"])
 
@@ -149,7 +213,8 @@ class BacklogModule(Component):
             add_script(req, "agiletools/js/backlog.js")
             add_stylesheet(req, "agiletools/css/backlog.css")
 
-            milestones_select2 = Milestone.select_names_select2(self.env, include_complete=False)
+            catalogue = MilestoneCatalogue(self.env)
+            milestones_select2 = catalogue.select2()
             milestones_select2['results'].insert(0, {
                 "children": [],
                 "text": "Product Backlog",
@@ -157,8 +222,7 @@ class BacklogModule(Component):
                 "is_backlog": True,
             })
 
-            milestones_flat = [milestone.name for milestone in
-                               Milestone.select(self.env, include_completed=False, include_children=True)]
+            milestones_flat = catalogue.open_names()
 
             script_data = { 
                 'milestones': milestones_select2,
@@ -167,7 +231,7 @@ class BacklogModule(Component):
                 }
 
             add_script_data(req, script_data)
-            data = {'top_level_milestones': Milestone.select(self.env)}
+            data = {'top_level_milestones': catalogue.top_level()}
             # Just post the basic template, with a list of milestones
             # The JS will then make a request for tickets in no milestone
             # and tickets in the most imminent milestone
@@ -194,50 +258,164 @@ class BacklogModule(Component):
         return [resource_filename(__name__, 'templates')]
 
     # Own methods
+    def _get_closed_statuses(self):
+        """Return a dict of the closed statuses of each ticket type which
+        has any."""
+        return WorkflowCatalogue(self.env).closed_statuses()
+
+    def _open_constraints(self, constraints=None):
+        """Return Query constraints for the tickets matching `constraints`
+        which aren't in one of the closed statuses of their type.
+
+        Each type with closed statuses gets its own set of constraints, and
+        one more set covers all other types. Query ORs the sets together.
+        """
+        constraints = constraints or {}
+        closed_statuses = self._get_closed_statuses()
+
+        open_constraints = []
+        for type_, statuses in sorted(closed_statuses.iteritems()):
+            open_constraints.append(dict(constraints, type=[type_],
+                                         status=['!' + s for s in statuses]))
+
+        other_types = dict(constraints)
+        if closed_statuses:
+            other_types['type'] = ['!' + t for t in sorted(closed_statuses)]
+        open_constraints.append(other_types)
+        return open_constraints
+
+    def _get_number(self, result, field):
+        return self._to_number(result.get(field))
+
+    def _to_number(self, value):
+        try:
+            return float(value)
+        except (ValueError, TypeError):
+            return 0
+
+    def _get_totals(self, results):
+        return {
+            'tickets': len(results),
+            'hours': sum(self._get_number(r, 'remaininghours') for r in results),
+            'effort': sum(self._get_number(r, 'effort') for r in results),
+            }
+
+    def _get_milestone_totals(self, req, milestones):
+        """Return a dict of the totals of the open tickets in each of
+        `milestones` which the user may view, without loading the tickets.
+
+        The tickets are counted in one query grouped by milestone and by
+        their remaining hours and effort, so each distinct value is only
+        turned into a number once, the same way as for loaded tickets.
+        """
+        totals = dict((name, {'tickets': 0, 'hours': 0, 'effort': 0})
+                      for name in milestones)
+
+        allowed = AgileToolsSystem(self.env).permission_for_all(req)
+        if allowed is None:
+            # Some tickets may be hidden from the user, so count the ones
+            # they can see
+            by_milestone = dict((name, []) for name in milestones)
+            for ticket in self._get_permitted_tickets(req,
+                                    constraints={'milestone': milestones}):
+                by_milestone.setdefault(ticket['milestone'] or '', []).append(ticket)
+            return dict((name, self._get_totals(by_milestone[name]))
+                        for name in milestones)
+        elif not allowed:
+            return totals
+
+        milestone_sql, args = milestones_sql(milestones, 't.milestone')
+        closed_sql = []
+        for type_, statuses in sorted(self._get_closed_statuses().iteritems()):
+            closed_sql.append("(COALESCE(t.type, '')=%%s AND "
+                              "COALESCE(t.status, '') IN (%s))"
+                              % ",".join(["%s"] * len(statuses)))
+            args += [type_] + statuses
+        open_sql = " AND NOT (%s)" % " OR ".join(closed_sql) \
+                   if closed_sql else ""
+
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT COALESCE(t.milestone, ''), h.value, e.value, COUNT(*)
+            FROM ticket t
+            LEFT OUTER JOIN ticket_custom h
+                ON h.ticket=t.id AND h.name='remaininghours'
+            LEFT OUTER JOIN ticket_custom e
+                ON e.ticket=t.id AND e.name='effort'
+            WHERE %s%s
+            GROUP BY COALESCE(t.milestone, ''), h.value, e.value
+            """ % (milestone_sql, open_sql), args)
+        for milestone, hours, effort, count in cursor:
+            if milestone in totals:
+                total = totals[milestone]
+                total['tickets'] += count
+                total['hours'] += self._to_number(hours) * count
+                total['effort'] += self._to_number(effort) * count
+        return totals
+
+    def _get_milestone_data(self, req, milestone, tickets, from_iso=None,
+                            to_iso=None, columns=False, offset=None,
+                            totals=None):
+        """Return the response for the open `tickets` of `milestone`, with
+        the ticket data in the compact format when `columns` is set.
+
+        When `totals` are given, `tickets` is the window of the milestone's
+        tickets starting at `offset`, and `totals` are those of all of them.
+        """
+        def ticket_data(tickets):
+            data = self._get_ticket_data(req, tickets)
+            return to_columns(data) if columns else data
+
+        if from_iso and to_iso:
+            # Tickets changed in the period, and the new order if any were
+            # moved
+            return {
+                'tickets': ticket_data(tickets),
+                'positions': AgileToolsSystem(self.env).positions_if_moved(
+                    milestone, parse_date(from_iso, utc),
+                    parse_date(to_iso, utc)),
+                }
+        elif totals is None:
+            return {'tickets': ticket_data(tickets)}
+        else:
+            # Only a window of the milestone's tickets, the client works out
+            # what it hasn't loaded yet from the totals
+            return {
+                'tickets': ticket_data(tickets),
+                'offset': offset,
+                'total': totals['tickets'],
+                'totals': totals,
+                }
+
     def _get_ticket_data(self, req, results):
         ats = AgileToolsSystem(self.env)
-        loc = LogicaOrderController(self.env)
-        closed_statuses = loc.type_and_statuses_for_closed_statusgroups()
 
-        # TODO calculate which statuses are closed using the query system
-        # when it is able to handle this
+        positions = ats.positions(result['id'] for result in results)
+        names = UserDirectory(self.env).display_names(
+            result['reporter'] for result in results)
+
         tickets = []
         for result in results:
-            if result['status'] not in closed_statuses[result['type']]:
-                filtered_result = dict((k, v)
-                                   for k, v in result.iteritems()
-                                   if k in self.fields)
-
-                if "remaininghours" in filtered_result:
-                    try:
-                        hours = float(filtered_result["remaininghours"])
-                    except (ValueError, TypeError):
-                        hours = 0
-                    del filtered_result["remaininghours"]
-                else:
-                    hours = 0
-
-                if "effort" in filtered_result:
-                    try:
-                        storypoints = float(filtered_result['effort'])
-                    except (ValueError, TypeError):
-                        storypoints = 0
-                else:
-                    storypoints = 0
-
-                reporter = filtered_result["reporter"]
-                session = DetachedSession(self.env, reporter)
-
-                filtered_result.update({
-                    'id': result['id'],
-                    'position': ats.position(result['id']),
-                    'hours': hours,
-                    'effort': storypoints,
-                    'reporter': session.get('name', reporter),
-                    'changetime': to_utimestamp(filtered_result['changetime'])
-                    })
-
-                tickets.append(filtered_result)
+            filtered_result = dict((k, v)
+                               for k, v in result.iteritems()
+                               if k in self.fields)
+
+            hours = self._get_number(filtered_result, "remaininghours")
+            filtered_result.pop("remaininghours", None)
+            storypoints = self._get_number(filtered_result, "effort")
+
+            filtered_result.update({
+                'id': result['id'],
+                'position': positions[result['id']],
+                'hours': hours,
+                'effort': storypoints,
+                'reporter': names.get(filtered_result['reporter'],
+                                      filtered_result['reporter']),
+                'changetime': to_utimestamp(filtered_result['changetime'])
+                })
+
+            tickets.append(filtered_result)
 
         return tickets
 
@@ -264,10 +442,217 @@ class BacklogModule(Component):
             else:
                 ticket.save_changes(req.authname, "", when=datetime.now(utc))
 
-    def _get_permitted_tickets(self, req, constraints=None):
-        qry = Query(self.env, constraints=constraints, cols=self.fields, max=0, order="_dynamic")
-        return [ticket for ticket in qry.execute(req)
-                if 'TICKET_VIEW' in req.perm('ticket', ticket['id'])]
+    def _save_tickets(self, req, ids, milestone, changetimes):
+        """Move the tickets with `ids` to `milestone`.
+
+        Each ticket is validated as `_save_ticket` would, checking for
+        collisions against its entry in `changetimes`, and the tickets which
+        pass are saved together in one transaction. Returns a list of
+        [<ticket_id>, [<error>, ...]] lists for the tickets which failed.
+        """
+        tm = TicketModule(self.env)
+        tickets = self._load_tickets(ids)
+        valid = []
+        errors_by_ticket = []
+        for int_ticket, ts in zip(ids, changetimes):
+            ticket = tickets.get(int_ticket)
+            if ticket is None:
+                errors_by_ticket.append([int_ticket, ["Not a valid ticket"]])
+                continue
+
+            req.args["milestone"] = milestone
+            if ts:
+                req.args["ts"] = ts
+            else:
+                req.args.pop("ts", None)
+            # Identical warnings are only added to the request once, so
+            # start afresh to report them against every ticket
+            req.chrome['warnings'] = []
+
+            tm._populate(req, ticket, plain_fields=True)
+            changes, problems = tm.get_ticket_changes(req, ticket, "btn_save")
+            if problems:
+                errors_by_ticket.append([int_ticket, problems])
+            else:
+                tm._apply_ticket_changes(ticket, changes)
+                if tm._validate_ticket(req, ticket, force_collision_check=True):
+                    valid.append(ticket)
+                else:
+                    errors_by_ticket.append([int_ticket,
+                                             req.chrome['warnings']])
+
+            if len(errors_by_ticket) > 5:
+                errors_by_ticket.append("More than 5 tickets failed "
+                                        "validation, stopping.")
+                break
+
+        self._save_changes(valid, req.authname, datetime.now(utc))
+        return errors_by_ticket
+
+    def _load_tickets(self, ids, chunk_size=500):
+        """Return a dict of the existing tickets with `ids`, loaded as
+        `Ticket(self.env, id)` would with two queries per `chunk_size`
+        tickets."""
+        tickets = {}
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        ids = list(set(ids))
+
+        template = Ticket(self.env)
+        for row in chunked_in(cursor,
+                              "SELECT id, %s FROM ticket WHERE id IN (%%s)"
+                              % ",".join(template.std_fields),
+                              ids, chunk_size):
+            ticket = Ticket(self.env)
+            ticket.id = row[0]
+            ticket.resource = ticket.resource(id=row[0])
+            ticket.values = {}
+            for field, value in zip(ticket.std_fields, row[1:]):
+                if field in ticket.time_fields:
+                    ticket.values[field] = from_utimestamp(value)
+                elif value is None:
+                    ticket.values[field] = empty
+                else:
+                    ticket.values[field] = value
+            tickets[ticket.id] = ticket
+
+        for id, name, value in chunked_in(cursor, """
+                SELECT ticket, name, value FROM ticket_custom
+                WHERE ticket IN (%s)""", ids, chunk_size):
+            ticket = tickets.get(id)
+            if ticket is not None and name in ticket.custom_fields:
+                ticket.values[name] = empty if value is None else value
+        return tickets
+
+    def _save_changes(self, tickets, author, when):
+        """Save the changes made to `tickets` in one transaction, writing
+        the same rows as `Ticket.save_changes` with an empty comment, then
+        notify the change listeners.
+
+        Tickets whose component or cc changed are left to
+        `Ticket.save_changes` as it adjusts those fields itself.
+        """
+        tickets = [ticket for ticket in tickets
+                   if any(ticket.values.get(k) != v
+                          for k, v in ticket._old.iteritems())]
+        if not tickets:
+            return
+        when_ts = to_utimestamp(when)
+        saved = []
+
+        @self.env.with_transaction()
+        def do_save(db):
+            cursor = db.cursor()
+            ids = [ticket.id for ticket in tickets]
+            holders = ",".join(["%s"] * len(ids))
+            cnums = self._next_comment_numbers(cursor, ids)
+            cursor.execute("""
+                SELECT ticket, name FROM ticket_custom
+                WHERE ticket IN (%s)""" % holders, ids)
+            custom_rows = set(cursor.fetchall())
+
+            std_updates = {}
+            custom_updates = []
+            custom_inserts = []
+            change_rows = []
+            for ticket in tickets:
+                if 'component' in ticket._old or 'cc' in ticket._old:
+                    ticket.save_changes(author, "", when=when)
+                    continue
+                db_values = ticket._to_db_types(ticket.values)
+                old_db_values = ticket._to_db_types(ticket._old)
+                for name in ticket._old:
+                    value = db_values.get(name)
+                    if name not in ticket.custom_fields:
+                        std_updates.setdefault(name, []).append(
+                            (value, ticket.id))
+                    elif (ticket.id, name) in custom_rows:
+                        custom_updates.append((value, ticket.id, name))
+                    else:
+                        custom_inserts.append((ticket.id, name, value))
+                    change_rows.append((ticket.id, when_ts, author, name,
+                                        old_db_values.get(name), value))
+                # Always save the comment, even if empty
+                change_rows.append((ticket.id, when_ts, author, 'comment',
+                                    cnums[ticket.id], ''))
+                saved.append((ticket, ticket._old))
+
+            cursor.executemany("UPDATE ticket SET changetime=%s WHERE id=%s",
+                               [(when_ts, ticket.id) for ticket, _ in saved])
+            for name, rows in std_updates.iteritems():
+                cursor.executemany("UPDATE ticket SET %s=%%s WHERE id=%%s"
+                                   % name, rows)
+            cursor.executemany("""
+                UPDATE ticket_custom SET value=%s WHERE ticket=%s AND name=%s
+                """, custom_updates)
+            cursor.executemany("""
+                INSERT INTO ticket_custom (ticket, name, value)
+                VALUES (%s, %s, %s)""", custom_inserts)
+            cursor.executemany("""
+                INSERT INTO ticket_change
+                    (ticket, time, author, field, oldvalue, newvalue)
+                VALUES (%s, %s, %s, %s, %s, %s)""", change_rows)
+
+        listeners = TicketSystem(self.env).change_listeners
+        for ticket, old_values in saved:
+            ticket._old = {}
+            ticket.values['changetime'] = when
+            for listener in listeners:
+                listener.ticket_changed(ticket, "", author, old_values)
+
+    def _next_comment_numbers(self, cursor, ids):
+        """Return a dict mapping each of `ids` to the number of its next
+        comment, counted as `Ticket.save_changes` does."""
+        cursor.execute("""
+            SELECT DISTINCT tc1.ticket, tc1.time, COALESCE(tc2.oldvalue, '')
+            FROM ticket_change AS tc1
+            LEFT OUTER JOIN ticket_change AS tc2
+            ON tc2.ticket=tc1.ticket AND tc2.time=tc1.time
+               AND tc2.field='comment'
+            WHERE tc1.ticket IN (%s)
+            ORDER BY tc1.ticket, tc1.time DESC
+            """ % ",".join(["%s"] * len(ids)), ids)
+        nums = dict.fromkeys(ids, 0)
+        numbered = set()
+        for id, ts, old in cursor:
+            if id in numbered:
+                continue
+            # Use oldvalue if available, else count edits
+            try:
+                nums[id] += int(old.rsplit('.', 1)[-1])
+                numbered.add(id)
+            except ValueError:
+                nums[id] += 1
+        return dict((id, str(num + 1)) for id, num in nums.iteritems())
+
+    def _missing_tickets(self, ids, chunk_size=500):
+        """Return the sorted list of `ids` which aren't ticket ids."""
+        ids = set(ids)
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        found = set(id_ for id_, in chunked_in(cursor,
+                        "SELECT id FROM ticket WHERE id IN (%s)",
+                        sorted(ids), chunk_size))
+        return sorted(ids - found)
+
+    def _get_permitted_tickets(self, req, constraints=None, offset=0,
+                               limit=None):
+        """Return the open tickets matching `constraints` which the user
+        may view, or only `limit` of them from `offset` on.
+
+        The offset is applied before checking permissions, so it is only
+        meant for users who may view all tickets or none.
+        """
+        qry = Query(self.env, constraints=self._open_constraints(constraints),
+                    cols=self.fields + ("milestone", ), max=limit or 0,
+                    order="_dynamic")
+        if limit:
+            qry.offset = offset
+        results = qry.execute(req)
+        if limit and not qry.has_more_pages:
+            # Query doesn't page when all results fit in one page
+            results = results[offset:offset + limit]
+        return AgileToolsSystem(self.env).viewable_tickets(req, results)
 
     def _json_errors(self, req, error):
         return self._json_send(req, {'errors': error})
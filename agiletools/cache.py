@@ -0,0 +1,131 @@
+#
+# Copyright (C) 2015 CGI IT UK Ltd
+# All rights reserved.
+#
+
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache(object):
+    """A cache holding at most `size` items, dropping the least recently
+    used ones first.
+
+    `generation` identifies the version of the underlying data the cache
+    holds. Reading at a newer generation empties the cache, and values read
+    from the database are only stored if no write happened in the meantime.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get_many(self, keys, generation):
+        """Return a dict of the cached values for `keys` at `generation`,
+        and a list of the keys which aren't cached."""
+        with self._lock:
+            self._move_to(generation)
+            found = {}
+            missing = []
+            for key in keys:
+                try:
+                    value = self._items.pop(key)
+                except KeyError:
+                    missing.append(key)
+                else:
+                    self._items[key] = value
+                    found[key] = value
+            self.hits += len(found)
+            self.misses += len(missing)
+            return found, missing
+
+    def set_many(self, items, generation):
+        """Store the `(key, value)` pairs in `items`, read at `generation`.
+        Nothing is stored if the cache has moved on since."""
+        with self._lock:
+            if generation == self.generation:
+                self._store(items)
+
+    def written(self, generation, changes=None):
+        """Move on to `generation` after a write of our own. When the cache
+        was current before the write and `changes` holds every item the
+        write changed, the cache is patched with them, otherwise it is
+        emptied."""
+        with self._lock:
+            if changes is None or self.generation != generation - 1:
+                self._items.clear()
+            else:
+                self._store(changes.iteritems())
+            self.generation = generation
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.generation = None
+
+    def _move_to(self, generation):
+        if generation != self.generation:
+            self._items.clear()
+            self.generation = generation
+
+    def _store(self, items):
+        for key, value in items:
+            self._items.pop(key, None)
+            self._items[key] = value
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+class TTLCache(object):
+    """A cache whose items expire `ttl` seconds after they were stored."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        found, _ = self.get_many([key])
+        return found.get(key, default)
+
+    def get_many(self, keys):
+        """Return a dict of the cached values for `keys`, and a list of the
+        keys which aren't cached or have expired."""
+        now = time.time()
+        found = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                item = self._items.get(key)
+                if item is not None and item[0] > now:
+                    found[key] = item[1]
+                else:
+                    self._items.pop(key, None)
+                    missing.append(key)
+        return found, missing
+
+    def set(self, key, value):
+        self.set_many([(key, value)])
+
+    def set_many(self, items):
+        expires = time.time() + self.ttl
+        with self._lock:
+            for key, value in items:
+                self._items[key] = (expires, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
@@ -2,13 +2,23 @@ from trac.db.schema import Table, Column, Index
 
 old_name = 'taskboard_schema'
 name = 'agiletools_version'
-version = 4
+version = 6
+
+# system table entry recording the day up to which the position history
+# has been compacted
+history_compacted_name = 'agiletools_history_compacted'
+
+# system table entry counting the writes made to ticket_positions, used to
+# detect concurrent writers. When ranking by milestone each milestone has its
+# own entry, named after this one followed by ':' and the milestone.
+generation_name = 'agiletools_positions_generation'
 
 schema = [
     Table('ticket_positions', key=('ticket', 'position'))[
         Column('ticket', type='int'),
         Column('position', type='int'),
         Index(['ticket', 'position'], unique=True),
+        Index(['position']),
     ],
     Table('ticket_positions_change', key=('ticket', 'time'))[
         Column('ticket', type='int'),
@@ -11,7 +11,7 @@
  * prioritised tickets in one go, and move them into a new milestone with a
  * single click. The number of tickets and total hours in a milestone are shown
  * at the top of the page, and are updated when the user makes a selection.
- * TODO - make the backlog properly support live updates.
+ * Changes made by other users are polled for all milestones in one request.
  * =============================================================================
  * @requires jQuery (>= 1.7)
  * @requires jQuery UI Sortable (>= 1.10)
@@ -35,7 +35,7 @@
   // @namespace
   // BACKLOG PUBLIC CLASS DEFINITION
   // ===============================
-  var Backlog = Class.extend({
+  var Backlog = $.LiveUpdater.extend({
 
     /**
      * Initialise a new backlog
@@ -59,15 +59,112 @@
       this.milestoneOrder = [];
 
       for(i = 0; i < initialMilestones.length; i ++) {
-        this.add_milestone(initialMilestones[i], false);
+        this.add_milestone(initialMilestones[i], false, true);
       }
+      this.get_tickets(true);
 
       // Replace the URL state to add data to this history point
       this.update_url(true);
 
+      // Ticket changes and moves in every milestone every 30 seconds,
+      // complete refresh every 30 minutes
+      this.init_updates({
+        data: $.proxy(function() { return { milestones: this.milestoneOrder }; }, this),
+        interval: 30,
+        fullRefreshAfter: 60
+      });
+
       this.events();
     },
 
+    /**
+     * Make a single Ajax call for the tickets of every milestone shown,
+     * handing each milestone its part of the response
+     * @memberof Backlog
+     * @param {Boolean} [first] - Whether this is the first run
+     * @returns {Deferred}
+     */
+    get_tickets: function(first) {
+      var names = this.milestoneOrder.slice(0),
+          limit = BacklogMilestone.prototype.pageSize,
+          _this = this, xhr, i;
+
+      for(i = 0; i < names.length; i ++) {
+        limit = Math.max(limit, this.milestones[names[i]].length);
+      }
+
+      xhr = $.ajax({
+        data: {
+          milestones: names,
+          offset: 0,
+          limit: limit,
+          format: "columns"
+        },
+        converters: $.columnConverters,
+        cache: false,
+        ifModified: true,
+        traditional: true
+      });
+
+      $.when(xhr).then(function(data, textStatus) {
+        for(i = 0; i < names.length; i ++) {
+          // Milestones may have been closed while waiting
+          if(_this.milestones.hasOwnProperty(names[i])) {
+            _this.milestones[names[i]]._get_tickets_response(first,
+              data && data.milestones[names[i]], textStatus);
+          }
+        }
+      });
+      return xhr;
+    },
+
+    /**
+     * LiveUpdater's update method: hand each milestone its changes, and
+     * remove the tickets which left the milestones shown or were closed
+     * @memberof Backlog
+     * @param {Object} data - Response with the changes by milestone
+     *   @param {Array} [data.otherChanges] - IDs of other tickets changed
+     */
+    process_update: function(data) {
+      var name, i, ticket, from;
+
+      // Leave the tickets alone while the user is rearranging them, and
+      // ask for the same changes again with the next update
+      for(name in this.milestones) {
+        if(this.milestones.hasOwnProperty(name) && this.milestones[name].rearranging()) {
+          this.defer_update();
+          return;
+        }
+      }
+
+      for(name in data.milestones) {
+        if(data.milestones.hasOwnProperty(name) && this.milestones.hasOwnProperty(name)) {
+          this.milestones[name].process_update(data.milestones[name]);
+        }
+      }
+
+      if(data.otherChanges) {
+        for(i = 0; i < data.otherChanges.length; i ++) {
+          ticket = this.tickets[data.otherChanges[i]];
+          if(ticket) {
+            from = ticket.milestone;
+            ticket.remove();
+            if(from.length === 0) from.set_empty_message();
+            from.set_stats();
+          }
+        }
+      }
+    },
+
+    /**
+     * LiveUpdater's complete refresh method
+     * @memberof Backlog
+     * @returns {Promise}
+     */
+    refresh: function() {
+      return this.get_tickets().promise();
+    },
+
     /**
      * Draw the backlog, dialogs, and controls
      * @memberof Backlog
@@ -219,14 +316,15 @@
      * @memberof Backlog
      * @param {string} name - The name of the milestone
      * @param {Boolean} updateUrl - Whether to update the page's URL
+     * @param {Boolean} [deferLoad] - Whether the caller requests the tickets
      */
-    add_milestone: function(name, updateUrl) {
+    add_milestone: function(name, updateUrl, deferLoad) {
       if(this.length < this.milestoneLimit) {
 
         // Only add a milestone block if a valid name is supplied
         if(name === "" || $.inArray(name, window.milestonesFlat) !== -1) {
           this.length ++;
-          this.milestones[name] = new BacklogMilestone(this, name);
+          this.milestones[name] = new BacklogMilestone(this, name, deferLoad);
           this.milestoneOrder.push(name);
           this.add_remove_milestone(updateUrl);
         }
@@ -464,7 +562,7 @@
   // @namespace
   // BACKLOG MILESTONE PRIVATE CLASS DEFINITION
   // ==========================================
-  var BacklogMilestone = $.LiveUpdater.extend({
+  var BacklogMilestone = Class.extend({
 
     /**
      * Initialise a new milestone (invoked by the Backlog)
@@ -472,8 +570,9 @@
      * @alias BacklogMilestone
      * @param {Backlog} backlog - Parent backlog
      * @param {string} name - The name of the milestone
+     * @param {Boolean} [deferLoad] - Whether the backlog requests the tickets
      */
-    init: function(backlog, name) {
+    init: function(backlog, name, deferLoad) {
       this.backlog = backlog;
       this.name = name;
       this.milestone_url = window.tracBaseUrl + "milestone/" + encodeURIComponent(this.name);
@@ -484,15 +583,9 @@
       this.total_storypoints = 0;
       this.length = 0;
       this.tickets = {};
-      this.get_tickets(true);
-
-      // TODO make normal updates work normally
-      // Complete refresh every 10 minutes
-      this.init_updates({
-        data: { milestone: this.name },
-        interval: 600,
-        fullRefreshAfter: 1
-      });
+      this.nextOffset = 0;
+      this.unloaded = { tickets: 0, hours: 0, effort: 0 };
+      if(!deferLoad) this.get_tickets(true);
 
       this.events();
     },
@@ -523,6 +616,12 @@
         this.$moveTicketsBtn      = draw_button("chevron-right", "Move selected tickets to neighbouring milestone").addClass("hidden").appendTo(this.$selectionControls);
         this.$moveTicketsBtn.on("click", $.proxy(this.move_selection, this));
 
+        this.$moveTopBtn          = draw_button("angle-double-up", "Move selected tickets to top of milestone").appendTo(this.$selectionControls);
+        this.$moveTopBtn.on("click", $.proxy(this.reorder_selection, this, false));
+        this.$moveBottomBtn       = draw_button("angle-double-down", "Move selected tickets to bottom of milestone").appendTo(this.$selectionControls);
+        this.$moveBottomBtn.on("click", $.proxy(this.reorder_selection, this, true));
+        this.$reorderBtns = this.$moveTopBtn.add(this.$moveBottomBtn).addClass("hidden");
+
         this.$selectionToggleBtn  = draw_button("check", "Select all").appendTo(this.$selectionControls);
         this.selection_unselected();
       }
@@ -557,13 +656,32 @@
     },
 
     /**
-     * Make an Ajax call to retrieve a milestone's tickets
+     * Number of tickets requested at a time, more are requested as the
+     * user scrolls down
+     * @memberof BacklogMilestone
+     */
+    pageSize: 100,
+
+    /**
+     * Make an Ajax call to retrieve the first page of a milestone's tickets
+     * (or as many as are currently shown, when refreshing). The server
+     * replies "304 Not Modified" when nothing changed since the last call.
      * @memberof BacklogMilestone
      * @param {Boolean} [first] - Whether this is the first run
      * @returns {Deferred}
      */
     get_tickets: function(first) {
-      this.xhr = $.ajax({ data: { milestone: this.name }, cache: false });
+      this.xhr = $.ajax({
+        data: {
+          milestone: this.name,
+          offset: 0,
+          limit: Math.max(this.pageSize, this.length),
+          format: "columns"
+        },
+        converters: $.columnConverters,
+        cache: false,
+        ifModified: true
+      });
 
       $.when(this.xhr).then($.proxy(this, "_get_tickets_response", first));
       return this.xhr;
@@ -574,8 +692,11 @@
      * @private
      * @memberof BacklogMilestone
      */
-    _get_tickets_response: function(first, data) {
-      var ticket;
+    _get_tickets_response: function(first, data, textStatus) {
+      if(textStatus === "notmodified") {
+        this._do_filter();
+        return;
+      }
 
       if(!first) {
         if(this.backlog.editable) this.multi_pick_stop();
@@ -583,20 +704,106 @@
         this.$tBody.html("");
       }
 
-      if(data.hasOwnProperty("tickets")) {
-        for(ticket in data.tickets) {
-          if(data.tickets.hasOwnProperty(ticket)) {
-            this.add_ticket(data.tickets[ticket]);
-          }
-        }
-      }
+      this._add_page(data);
       if(this.length === 0) this.set_empty_message();
       this.set_sortable();
       this._do_filter();
     },
 
     /**
-     * LiveUpdater's complete refresh method
+     * Request the next page of tickets, or all remaining tickets
+     * @memberof BacklogMilestone
+     * @param {Boolean} [all] - Whether to request all remaining tickets
+     * @returns {Promise}
+     */
+    get_more_tickets: function(all) {
+      if(this.moreXhr) return this.moreXhr.promise();
+      if(!this.unloaded.tickets) return $.when().promise();
+
+      this.moreXhr = $.ajax({
+        data: {
+          milestone: this.name,
+          offset: this.nextOffset,
+          limit: all ? this.unloaded.tickets : this.pageSize,
+          format: "columns"
+        },
+        converters: $.columnConverters,
+        cache: false
+      });
+
+      $.when(this.moreXhr)
+        .then($.proxy(this, "_get_more_tickets_response"))
+        .always($.proxy(function() { delete this.moreXhr; }, this));
+      return this.moreXhr.promise();
+    },
+
+    /**
+     * Append a further page of tickets
+     * @private
+     * @memberof BacklogMilestone
+     */
+    _get_more_tickets_response: function(data) {
+      this._add_page(data);
+      this.set_stats();
+    },
+
+    /**
+     * Add the tickets from a page of tickets not yet shown, and work out
+     * what is left to request from the milestone's totals
+     * @private
+     * @memberof BacklogMilestone
+     * @param {Object} data - Response with tickets, offset and totals
+     */
+    _add_page: function(data) {
+      var i, tData;
+
+      if(data.hasOwnProperty("tickets")) {
+        for(i = 0; i < data.tickets.length; i ++) {
+          tData = data.tickets[i];
+          // Tickets may have moved up a page since the previous request
+          if(!this.tickets.hasOwnProperty(tData.id)) this.add_ticket(tData);
+        }
+        this.nextOffset = (data.offset || 0) + data.tickets.length;
+      }
+      this.unloaded = this._unloaded(data.totals);
+    },
+
+    /**
+     * The part of the milestone's totals not yet loaded
+     * @private
+     * @memberof BacklogMilestone
+     * @param {Object} [totals] - Number of tickets, hours and effort
+     * @returns {Object} Number of tickets, hours and effort not loaded
+     */
+    _unloaded: function(totals) {
+      var left = function(total, loaded) {
+        return Math.max(Math.round((total - loaded) * 100) / 100, 0);
+      };
+
+      if(!totals) return { tickets: 0, hours: 0, effort: 0 };
+      return {
+        tickets: left(totals.tickets, this.length),
+        hours: left(totals.hours, this.total_hours),
+        effort: left(totals.effort, this.total_storypoints)
+      };
+    },
+
+    /**
+     * Request more tickets once the user scrolls near the bottom. Pages are
+     * only ever added: rows scrolled past stay in the table, as sorting,
+     * multi-pick and manual moves all work on the rendered rows
+     * @memberof BacklogMilestone
+     */
+    scroll_tickets: function() {
+      var wrap = this.$tktWrap[0];
+
+      if(wrap.scrollTop + wrap.clientHeight >= wrap.scrollHeight - 200) {
+        this.get_more_tickets();
+      }
+    },
+
+    /**
+     * Reload the milestone's tickets
      * @memberof BacklogMilestone
      * @param {Boolean} removeFilter - Whether to remove
      * @returns {Promise}
@@ -606,6 +813,90 @@
       return this.get_tickets().promise();
     },
 
+    /**
+     * Show the tickets changed since the last update (polled by the
+     * backlog), and reorder the tickets if any were moved
+     * @memberof BacklogMilestone
+     * @param {Object} data - Response with changed tickets and positions
+     */
+    process_update: function(data) {
+      var lastPosition = null,
+          i, id, tData, ticket, from;
+
+      for(id in this.tickets) {
+        if(this.tickets.hasOwnProperty(id)) {
+          lastPosition = Math.max(lastPosition, this.tickets[id].tData.position);
+        }
+      }
+
+      for(i = 0; i < data.tickets.length; i ++) {
+        tData = data.tickets[i];
+        ticket = this.backlog.tickets[tData.id];
+
+        if(ticket) {
+          from = ticket.milestone;
+          ticket.remove();
+          if(from !== this) {
+            if(from.length === 0) from.set_empty_message();
+            from.set_stats();
+          }
+        }
+        // Tickets beyond the loaded pages are shown once scrolled to
+        if(ticket || !this.unloaded.tickets || tData.position <= lastPosition) {
+          this.add_ticket(tData);
+        }
+      }
+
+      for(id in data.positions) {
+        if(data.positions.hasOwnProperty(id) && this.tickets.hasOwnProperty(id)) {
+          this.tickets[id].tData.position = data.positions[id];
+        }
+      }
+
+      if(data.tickets.length || !$.isEmptyObject(data.positions)) {
+        this.sort_tickets();
+        if(this.$container.hasClass("no-filter")) this.set_stats();
+        else this._do_filter();
+      }
+    },
+
+    /**
+     * Whether the user is dragging or picking tickets in the milestone
+     * @memberof BacklogMilestone
+     * @returns {Boolean}
+     */
+    rearranging: function() {
+      return !!(this.mpSelection || $(".ui-sortable-helper", this.$tBody).length);
+    },
+
+    /**
+     * Order the ticket rows by position, keeping tickets without one at
+     * the bottom in their current order
+     * @memberof BacklogMilestone
+     */
+    sort_tickets: function() {
+      var rows = $.map($("tr", this.$tBody).get(), function(row, index) {
+        var ticket = $(row).data("_self");
+        return ticket ? { ticket: ticket, index: index } : null;
+      });
+
+      rows.sort(function(a, b) {
+        var pa = a.ticket.tData.position, pb = b.ticket.tData.position;
+        if(pa === null || pb === null) {
+          if(pa !== pb) return pa === null ? 1 : -1;
+        }
+        else if(pa !== pb) {
+          return pa - pb;
+        }
+        return a.index - b.index;
+      });
+
+      for(var i = 0; i < rows.length; i ++) {
+        this.$tBody.append(rows[i].ticket.$container);
+      }
+      if(this.backlog.editable) this.refresh_sortables();
+    },
+
     /**
      * Instantiate a new MilestoneTicket based on ticket data
      * @memberof BacklogMilestone
@@ -666,9 +957,9 @@
         }
       }
       else {
-        hours = this.total_hours;
-        tickets = this.length;
-        storypoints = this.total_storypoints;
+        hours = this.total_hours + this.unloaded.hours;
+        tickets = this.length + this.unloaded.tickets;
+        storypoints = this.total_storypoints + this.unloaded.effort;
       }
       this.$stats.html(
         "<span title='Ticket count'><i class='fa fa-ticket'></i> " + tickets + "</span>" +
@@ -796,6 +1087,12 @@
         this.$container.addClass("no-filter");
       }
 
+      // Filters apply to all tickets, so load the rest of them first
+      else if(this.unloaded.tickets) {
+        this.get_more_tickets(true).then($.proxy(this, "_do_filter"));
+        return;
+      }
+
       // If we enter a hash, then instead of filtering we scroll to the ticket
       else if(queryString.indexOf("#") === 0) {
         ticketId = queryString.substring(1);
@@ -942,7 +1239,8 @@
      */
     remove_all_tickets: function() {
       var ticket;
-      this.xhr.abort();
+      if(this.xhr) this.xhr.abort();
+      if(this.moreXhr) this.moreXhr.abort();
 
       for(ticket in this.tickets) {
         if(this.tickets.hasOwnProperty(ticket)) {
@@ -1008,6 +1306,12 @@
       var mpHeight = this.$multiPick.height(),
           totalHeight = this.$tktWrap.height() + mpHeight;
 
+      // Selecting all tickets needs all of them loaded
+      if(this.unloaded.tickets) {
+        this.get_more_tickets(true).then($.proxy(this, "multi_pick_all"));
+        return;
+      }
+
       this.mpMinHeight = mpHeight;
 
       this.$tktWrap.scrollTop(this.$table.height());
@@ -1063,6 +1367,7 @@
       this.set_stats();
 
       this.$moveTicketsBtn.removeClass("hidden");
+      this.$reorderBtns.removeClass("hidden");
     },
 
     /**
@@ -1081,6 +1386,7 @@
       if(!(event_type == "scroll" && !this.mp_manual)) {
         $(window).off("mousemove");
         this.$moveTicketsBtn.addClass("hidden");
+        this.$reorderBtns.addClass("hidden");
         this.$mpPlaceholder.remove();
         this.$multiPick.removeAttr("style").removeClass("dragging");
         this.$tBody.sortable("enable");
@@ -1217,6 +1523,60 @@
       $move.attr("class", "fa fa-chevron-right hidden");
     },
 
+    /**
+     * Make a request to move all selected tickets to the top or bottom of
+     * the loaded tickets, keeping their order, in one batch
+     * @memberof BacklogMilestone
+     * @param {Boolean} bottom - Whether to move them to the bottom
+     */
+    reorder_selection: function(bottom) {
+      var selection = this.mpSelection || {},
+          ticketIds = [],
+          relative = null,
+          xhr;
+
+      $("tr:not(.ui-state-disabled)", this.$tBody).each(function() {
+        var ticket = $(this).data("_self");
+
+        if(!ticket) return;
+        if(selection.hasOwnProperty(ticket.tData.id)) {
+          ticketIds.push(ticket.tData.id);
+        }
+        // The first ticket not selected, or the last one when moving down
+        else if(bottom || relative === null) {
+          relative = ticket.tData.id;
+        }
+      });
+
+      if(!ticketIds.length || relative === null) return;
+
+      this.$reorderBtns.addClass("hidden");
+      xhr = $.ajax({
+        type: "POST",
+        data: {
+          "__FORM_TOKEN": window.formToken,
+          "tickets": ticketIds.join(","),
+          "relative": relative,
+          "relative_direction": bottom ? "after" : "before"
+        }
+      });
+
+      $.when(xhr).then($.proxy(this, "_reorder_selection_response", ticketIds));
+    },
+
+    /**
+     * Process the reorder selection request from the server
+     * @private
+     * @memberof BacklogMilestone
+     */
+    _reorder_selection_response: function(ticketIds, data) {
+      this.multi_pick_stop();
+      if(data.hasOwnProperty("errors")) {
+        this.multi_pick_show_errors([[ticketIds.join(", #"), data.errors]]);
+      }
+      this.refresh();
+    },
+
     /**
      * Initialise events for the milestone
      * @memberof BacklogMilestone
@@ -1224,6 +1584,7 @@
     events: function() {
       this.$filter.on("keyup", $.proxy(this.filter_tickets, this));
       if(this.$closeBtn) this.$closeBtn.on("click", $.proxy(this.remove, this));
+      this.$tktWrap.on("scroll", $.proxy(this.scroll_tickets, this));
 
       if(this.backlog.editable) {
         this.$multiPick.on("mousedown", $.proxy(this.multi_pick_start, this));
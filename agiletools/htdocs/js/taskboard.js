@@ -852,13 +852,18 @@
     },
 
     /**
-     * Completely refresh the task board. Useful when minute differences are not picked up
+     * Completely refresh the task board. Useful when minute differences are not picked up.
+     * The server replies "304 Not Modified" when nothing changed since the last refresh
      * @memberof Taskboard
      * @param {Boolean} [notify] - whether to make the update evident to the user
      * @returns {Promise}
      */
     refresh: function(notify) {
-      var xhr = $.ajax();
+      var xhr = $.ajax({
+        data: { format: "columns" },
+        converters: $.columnConverters,
+        ifModified: true
+      });
 
       if(notify) {
         this.$loadMsg = $("<div class='taskboard-refresh'>" +
@@ -877,14 +882,16 @@
      * @private
      * @memberof Taskboard
      */
-    _refresh_success: function(data) {
+    _refresh_success: function(data, textStatus) {
       var _this = this;
 
-      // Throw all of our data into the window object
-      $.extend(window, data);
+      if(textStatus !== "notmodified") {
+        // Throw all of our data into the window object
+        $.extend(window, data);
 
-      this.teardown();
-      this.construct(data.groups, data.tickets, data.currentWorkflow);
+        this.teardown();
+        this.construct(data.groups, data.tickets, data.currentWorkflow);
+      }
 
       if(this.$loadMsg) {
         $.wait(1000).then(function() {
@@ -1,5 +1,72 @@
 (function($, Class) { "use strict";
 
+  // COMPACT TICKET DATA
+  // ===================
+
+  /**
+   * Expand ticket data sent in the compact format (format=columns) back into
+   * objects. Each block of rows becomes a list of objects, or when grouped,
+   * the same nesting of groups with objects keyed by ticket id.
+   * @param {*} value - Parsed JSON response, or any part of one
+   * @returns {*} The response with every block of rows expanded
+   */
+  $.expandColumns = function(value) {
+    var key, i;
+
+    if($.isArray(value)) {
+      for(i = 0; i < value.length; i ++) value[i] = $.expandColumns(value[i]);
+    }
+    else if(value !== null && typeof value === "object") {
+      if($.isArray(value.columns) && $.isArray(value.rows)) {
+        return expand_block(value);
+      }
+      for(key in value) {
+        if(value.hasOwnProperty(key)) value[key] = $.expandColumns(value[key]);
+      }
+    }
+    return value;
+  };
+
+  function expand_block(block) {
+    var objects = [], i, j, row, object;
+
+    for(i = 0; i < block.rows.length; i ++) {
+      row = block.rows[i];
+      object = {};
+      for(j = 0; j < block.columns.length; j ++) {
+        object[block.columns[j]] = row[j];
+      }
+      objects.push(object);
+    }
+
+    function expand_group(group) {
+      var expanded = {}, name, k;
+
+      if($.isArray(group)) {
+        for(k = 0; k < group.length; k ++) {
+          expanded[block.keys[group[k]]] = objects[group[k]];
+        }
+      }
+      else {
+        for(name in group) {
+          if(group.hasOwnProperty(name)) expanded[name] = expand_group(group[name]);
+        }
+      }
+      return expanded;
+    }
+
+    return block.groups ? expand_group(block.groups) : objects;
+  }
+
+  /**
+   * Ajax converters for responses requested with format=columns
+   */
+  $.columnConverters = {
+    "text json": function(text) {
+      return $.expandColumns($.parseJSON(text));
+    }
+  };
+
   // TASKBOARD PUBLIC CLASS DEFINITION
   // =================================
   $.LiveUpdater = Class.extend({
@@ -45,17 +112,28 @@
     },
 
     get_update: function() {
-      var previous = this.lastUpdate;
+      this.updateFrom = this.lastUpdate;
       this.lastUpdate = this.iso_8601_datetime(new Date());
 
       return $.ajax({
         data: $.extend({
-          from: previous,
-          to: this.lastUpdate
-        }, this.updateData)
+          from: this.updateFrom,
+          to: this.lastUpdate,
+          format: "columns"
+        }, $.isFunction(this.updateData) ? this.updateData() : this.updateData),
+        converters: $.columnConverters,
+        traditional: true
       });
     },
 
+    /**
+     * Ask again for the changes of the last update with the next one, when
+     * they couldn't be shown yet
+     */
+    defer_update: function() {
+      this.lastUpdate = this.updateFrom;
+    },
+
     iso_8601_datetime: function(date) {
       function pad(n) { return n < 10 ? "0" + n : n; }
       return date.getUTCFullYear() + "-" +
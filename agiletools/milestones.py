@@ -0,0 +1,66 @@
+#
+# Copyright (C) 2015 CGI IT UK Ltd
+# All rights reserved.
+#
+
+from copy import deepcopy
+
+from trac.cache import cached
+from trac.core import Component, implements
+from trac.ticket.api import IMilestoneChangeListener
+from trac.ticket.model import Milestone
+
+class MilestoneCatalogue(Component):
+    """Keeps the milestone lists shown by the backlog and task board in
+    memory until a milestone is created, changed or deleted."""
+
+    implements(IMilestoneChangeListener)
+
+    # IMilestoneChangeListener methods
+    def milestone_created(self, milestone):
+        self.reset()
+
+    def milestone_changed(self, milestone, old_values):
+        self.reset()
+
+    def milestone_deleted(self, milestone):
+        self.reset()
+
+    # Own methods
+    def reset(self):
+        del self._names
+        del self._listings
+
+    def exists(self, name):
+        """Return whether a milestone called `name` exists."""
+        return name in self._names
+
+    def select2(self):
+        """Return the open milestones as given by
+        `Milestone.select_names_select2`."""
+        return deepcopy(self._listings['select2'])
+
+    def open_names(self):
+        """Return the names of the open milestones, including children."""
+        return list(self._listings['open_names'])
+
+    def top_level(self):
+        """Return the milestones as given by `Milestone.select`."""
+        return list(self._listings['top_level'])
+
+    @cached
+    def _names(self, db):
+        cursor = db.cursor()
+        cursor.execute("SELECT name FROM milestone")
+        return frozenset(name for name, in cursor)
+
+    @cached
+    def _listings(self, db):
+        return {
+            'select2': Milestone.select_names_select2(self.env,
+                                                      include_complete=False),
+            'open_names': [milestone.name for milestone in
+                           Milestone.select(self.env, include_completed=False,
+                                            include_children=True)],
+            'top_level': list(Milestone.select(self.env)),
+            }
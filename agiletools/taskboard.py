@@ -1,29 +1,52 @@
-from agiletools.api import AgileToolsSystem
+from agiletools.api import AgileToolsSystem, chunked_in, to_columns
+from agiletools.milestones import MilestoneCatalogue
+from agiletools.users import UserDirectory
+from agiletools.workflows import WorkflowCatalogue
 
 from collections import defaultdict
 from trac.core import Component, implements, TracError
-from trac.config import ListOption
+from trac.config import ChoiceOption, ListOption
 from trac.db.api import with_transaction
-from trac.resource import ResourceNotFound
 from trac.web import IRequestHandler
 from trac.web.chrome import (ITemplateProvider, add_script, add_stylesheet,
                              add_script_data, add_ctxtnav)
 from trac.ticket.query import Query
-from trac.ticket.model import Ticket, Milestone
+from trac.ticket.model import Ticket
 from trac.ticket.api import TicketSystem
 from trac.ticket.web_ui import TicketModule
 from trac.util.presentation import to_json
-from trac.util.translation import _
+from trac.util.translation import _, gettext
 from logicaordertracker.controller import LogicaOrderController, Operation
 from pkg_resources import resource_filename
 from datetime import datetime
 from genshi.builder import tag
 from itertools import chain
 import json
-from trac.util.datefmt import to_utimestamp, utc, pretty_age
+from trac.util.datefmt import parse_date, to_utimestamp, utc, pretty_age
 import re
 
-from simplifiedpermissionsadminplugin.simplifiedpermissions import SimplifiedPermissions
+class _TaskboardFields(object):
+    """The ticket fields the task board can group by and display, worked
+    out once from `TicketSystem.fields`, which is kept as `source`.
+
+    The field dicts are shared with the ticket system and must not be
+    changed, and their labels are untranslated.
+    """
+
+    def __init__(self, fields, restricted_fields, user_fields):
+        self.source = fields
+        self.grouping = [f for f in fields
+                         if (f.get("type") in ("select", "radio")
+                             or f.get("name") in user_fields)
+                         and f.get("name") not in restricted_fields]
+        self.grouping_names = [f['name'] for f in self.grouping]
+        self.grouping_by_name = dict((f['name'], f) for f in self.grouping)
+        # we need text for effort and hours for totalhours etc
+        self.display = [f for f in fields if f.get("type") != "textarea"]
+        self.display_names = [f['name'] for f in self.display]
+        self.display_name_set = frozenset(self.display_names)
+        self.types = [option for f in fields if f.get("name") == "type"
+                      for option in f.get("options", [])]
 
 class TaskboardModule(Component):
     implements(IRequestHandler, ITemplateProvider)
@@ -41,31 +64,35 @@ class TaskboardModule(Component):
             default="type, owner, priority, remaininghours, effort",
             doc="""fields displayed inside ticket nodes on taskboard"""
             )
+    user_columns = ChoiceOption("taskboard", "user_columns",
+            ["members", "used"],
+            doc="""columns shown when grouping by a user field: "members"
+            shows every member of a permission group, "used" only the users
+            the shown tickets belong to"""
+            )
 
     @property
     def valid_grouping_fields(self):
         """All fields with discrete values which aren't in restricted list"""
-        return [f for f in TicketSystem(self.env).get_ticket_fields()
-                if (f.get("type") in ("select", "radio")
-                or f.get("name") in self.user_fields)
-                and f.get("name") not in self.restricted_fields]
+        return self._translated(self._fields().grouping)
 
     @property
     def valid_grouping_field_names(self):
         """Iterable of valid groupby field names"""
-        return [f['name'] for f in self.valid_grouping_fields]
+        return self._fields().grouping_names
 
     @property
     def valid_display_fields(self):
         """All fields except time and userlist type fields"""
-        # we need text for effort and hours for totalhours etc
-        return [f for f in TicketSystem(self.env).get_ticket_fields()
-                  if f.get("type") != "textarea"]
+        return self._translated(self._fields().display)
 
     @property
     def valid_display_field_names(self):
         """Iterable of valid display field names"""
-        return [f['name'] for f in self.valid_display_fields]
+        return self._fields().display_names
+
+    def __init__(self):
+        self._field_snapshot = None
 
     #IRequestHandler methods
     def match_request(self, req):
@@ -90,19 +117,18 @@ class TaskboardModule(Component):
 
         user_saved_query = False
 
-        milestones = Milestone.select_names_select2(self.env, include_complete=False)
+        catalogue = MilestoneCatalogue(self.env)
+        # Polls only need the list of milestones to pick a default one
+        milestones = catalogue.select2() if not xhr else None
 
         # Try to find a user selected milestone in request - if not found 
         # check session_attribute for a user saved default, and if that is also
         # not found and fall back on the most upcoming milestone by due date
         milestone = req.args.get("milestone")
         milestone_not_found = False
-        if milestone:
-            try:
-                Milestone(self.env, milestone)
-            except ResourceNotFound:
-                milestone_not_found = True
-                milestone = None
+        if milestone and not catalogue.exists(milestone):
+            milestone_not_found = True
+            milestone = None
 
         if not milestone:
             # try and find a user saved default
@@ -113,8 +139,11 @@ class TaskboardModule(Component):
                 user_saved_query = True
 
             # fall back to most imminent milestone by due date
-            elif len(milestones["results"]):
-                milestone = milestones["results"][0]["text"]
+            else:
+                if milestones is None:
+                    milestones = catalogue.select2()
+                if len(milestones["results"]):
+                    milestone = milestones["results"][0]["text"]
 
         # Ajax post
         if req.args.get("ticket") and xhr:
@@ -127,21 +156,22 @@ class TaskboardModule(Component):
             if milestone:
                 constr['milestone'] = [milestone]
 
+            # Get all tickets by milestone and specify ticket fields to retrieve
+            cols = self._get_display_fields(req, user_saved_query)
+
             # Ajax update: tickets changed between a period
             if xhr:
                 from_iso = req.args.get("from", "")
                 to_iso = req.args.get("to", "")
                 if from_iso and to_iso:
                     constr['changetime'] = [from_iso + ".." + to_iso]
+                else:
+                    AgileToolsSystem(self.env).check_modified(req, milestone,
+                        [group_by, cols, req.args.get("format")]
+                        + self._response_state(milestone, group_by))
 
-            # Get all tickets by milestone and specify ticket fields to retrieve
-            cols = self._get_display_fields(req, user_saved_query)
             tickets = self._get_permitted_tickets(req, constraints=constr, 
                                                   columns=cols)
-            sorted_cols = sorted([f for f in self.valid_display_fields
-                    if f['name'] not in ('summary', 'type')],
-                    key=lambda f: f.get('label'))
-
             if tickets:
                 s_data = self.get_ticket_data(req, milestone, group_by, tickets)
                 s_data['total_tickets'] = len(tickets)
@@ -154,7 +184,11 @@ class TaskboardModule(Component):
             if xhr:
                 if constr.get("changetime"):
                     s_data['otherChanges'] = \
-                        self.all_other_changes(req, tickets, constr['changetime'])
+                        self.all_other_changes(req, tickets, from_iso, to_iso)
+                if tickets and req.args.get("format") == "columns":
+                    # Tickets are grouped by workflow and status, or by value
+                    depth = 2 if s_data['groupName'] == "status" else 1
+                    s_data['tickets'] = to_columns(s_data['tickets'], depth)
 
                 req.send(to_json(s_data), 'text/json')
             else:
@@ -165,11 +199,15 @@ class TaskboardModule(Component):
                     'group': group_by,
                     'default_columns': self.default_display_fields
                 })
+                display_fields = self.valid_display_fields
+                sorted_cols = sorted([f for f in display_fields
+                        if f['name'] not in ('summary', 'type')],
+                        key=lambda f: f.get('label'))
                 data.update({
                     'milestone_not_found': milestone_not_found,
                     'current_milestone': milestone,
                     'group_by_fields': self.valid_grouping_fields,
-                    'fields': dict((f['name'], f) for f in self.valid_display_fields),
+                    'fields': dict((f['name'], f) for f in display_fields),
                     'all_columns': [f['name'] for f in sorted_cols],
                     'col': cols,
                     'condensed': self._show_condensed_view(req, user_saved_query)
@@ -205,28 +243,27 @@ class TaskboardModule(Component):
 
         # what field data should we get
         query = Query(self.env, constraints=constraints, max=0, cols=columns)
-        tickets = []
-        for ticket in query.execute(req):
-            if 'TICKET_VIEW' in req.perm('ticket', ticket['id']):
-                for k in ('effort', 'remaininghours'):
-                    try:
-                        ticket[k] = float(ticket[k])
-                    except KeyError:
-                        pass
-                    except TypeError:
-                        ticket[k] = 0.0
-                tickets.append(ticket)
+        tickets = AgileToolsSystem(self.env).viewable_tickets(
+            req, query.execute(req))
+        for ticket in tickets:
+            for k in ('effort', 'remaininghours'):
+                try:
+                    ticket[k] = float(ticket[k])
+                except KeyError:
+                    pass
+                except TypeError:
+                    ticket[k] = 0.0
         return tickets
 
-    def all_other_changes(self, req, changed_in_scope, from_to):
-        """Return tuple of ticket IDs changed outside of query scope.
+    def all_other_changes(self, req, changed_in_scope, from_iso, to_iso):
+        """Return list of ticket IDs changed outside of query scope.
 
         This is relevant because if a ticket moves out of scope we need to know
-        about it so that it can be removed from the taskboard."""
-        constraints = {'changetime': from_to}
-        all_changes = self._get_permitted_tickets(req, constraints=constraints)
-        scope_ids = [t["id"] for t in changed_in_scope]
-        return [t["id"] for t in all_changes if t["id"] not in scope_ids]
+        about it so that it can be removed from the taskboard.
+        """
+        return AgileToolsSystem(self.env).other_changes(req,
+            (t["id"] for t in changed_in_scope),
+            parse_date(from_iso, utc), parse_date(to_iso, utc))
 
     def _set_default_query(self, req):
         """Processes a POST request to save a user based query on the task 
@@ -242,14 +279,13 @@ class TaskboardModule(Component):
 
         if all([default_milestone, default_group, default_fields, default_view]):
 
-            try:
-                Milestone(self.env, default_milestone)
-            except ResourceNotFound:
+            if not MilestoneCatalogue(self.env).exists(default_milestone):
                 data['invalid_milestone'] = default_milestone
 
             display_fields = default_fields.split(',')
+            valid_names = self._fields().display_name_set
             for f in chain([default_group], display_fields):
-                if f not in self.valid_display_field_names:
+                if f not in valid_names:
                     data['invalid_field'] = f
                     break
 
@@ -293,7 +329,25 @@ class TaskboardModule(Component):
         else:
             display_fields = self.default_display_fields
 
-        return sorted([f for f in display_fields if f in self.valid_display_field_names])
+        valid_names = self._fields().display_name_set
+        return sorted([f for f in display_fields if f in valid_names])
+
+    def _fields(self):
+        """Return the `_TaskboardFields` for the current ticket fields."""
+        # The ticket system replaces its cached fields whenever the ticket
+        # fields change, e.g. when an enum value or a custom field is added
+        fields = TicketSystem(self.env).fields
+        snapshot = self._field_snapshot
+        if snapshot is None or snapshot.source is not fields:
+            snapshot = _TaskboardFields(fields, self.restricted_fields,
+                                        self.user_fields)
+            self._field_snapshot = snapshot
+        return snapshot
+
+    def _translated(self, fields):
+        """Return copies of `fields` with their labels translated, as
+        `TicketSystem.get_ticket_fields` does."""
+        return [dict(f, label=gettext(f['label'])) for f in fields]
 
     def _show_condensed_view(self, req, default_query=False):
         """Calculates if the task board should show a condensed view of tickets.
@@ -329,14 +383,9 @@ class TaskboardModule(Component):
 
         # Try to group tickets by a user-specified valid field
         # if the field doesn't exist, we fall back to grouping by status
-        group_by = None
-
-        for field in self.valid_grouping_fields:
-            name = field.get("name")
-            if name in (grouped_by, "status"):
-                group_by = field
-                if name == grouped_by:
-                    break
+        fields = self._fields()
+        group_by = fields.grouping_by_name.get(grouped_by) \
+                   or fields.grouping_by_name.get("status")
 
         # Look for a custom get method, based on the valid group
         try:
@@ -348,7 +397,7 @@ class TaskboardModule(Component):
                 get_f = self._get_standard_data_
 
         ticket_data = get_f(req, milestone, group_by, results, 
-                            self.valid_display_field_names)
+                            fields.display_name_set)
         return self._formatted_data(ticket_data)
 
     def _get_standard_data_(self, req, milestone, field, results, fields):
@@ -359,18 +408,20 @@ class TaskboardModule(Component):
         # Allow for the unset option
         options = [""] + [option for option in field["options"]]
 
+        positions = ats.positions(result['id'] for result in results)
+        group_values = self._get_group_values(results, field)
+
         for result in results:
-            ticket = Ticket(self.env, result['id'])
             filtered_result = dict((k, v)
                                    for k, v in result.iteritems()
                                    if k in fields)
-            filtered_result['position'] = ats.position(result['id'])
+            filtered_result['position'] = positions[result['id']]
             filtered_result['_changetime'] = to_utimestamp(result['changetime'])
             # we use Trac's to_json() (through add_script_data), so
             # we'll replace any types which can't be json serialised
             for k, v in filtered_result.items():
                 if isinstance(v, datetime): filtered_result[k] = pretty_age(v)
-            group_field_val = ticket.get_value_or_default(field["name"]) or ""
+            group_field_val = group_values[result["id"]]
             tickets_json[group_field_val][result["id"]] = filtered_result
 
         return (field["name"], tickets_json, options)
@@ -378,45 +429,78 @@ class TaskboardModule(Component):
     def _get_user_data_(self, req, milestone, field, results, fields):
         """Get data grouped by users. Includes extra user info."""
         ats = AgileToolsSystem(self.env)
-        sp = SimplifiedPermissions(self.env)
+        udir = UserDirectory(self.env)
 
         tickets_json = defaultdict(lambda: defaultdict(dict))
 
-        all_users = []
-        user_data = {}
         use_avatar = self.config.get('avatar','mode').lower() != 'off'
+        href = req.href if use_avatar else None
+        group_values = self._get_group_values(results, field)
+        used = set(group_values.itervalues())
 
         # TODO: allow the task board to respect user groups
-        for group, data in sp.group_memberships().items():
-            for member in data['members']:
-                if member.sid not in user_data:
-                    all_users.append(member.sid);
-                    user_data[member.sid] = {
-                        'name': member.get("name", member.sid),
-                        'avatar': use_avatar and req.href.avatar(member.sid) or None
-                    }
+        if self.user_columns == 'used':
+            user_data, all_users = {}, []
+        else:
+            user_data, all_users = udir.group_members(href)
 
-        def name_for_sid(sid):
-            return user_data[sid]["name"] if sid in user_data else sid
+        # Users the tickets are grouped by who aren't in any group
+        others = used - set(user_data)
+        for sid, name in udir.display_names(others).iteritems():
+            user_data[sid] = {
+                'name': name,
+                'avatar': use_avatar and req.href.avatar(sid) or None
+            }
 
-        options = [""] + sorted(all_users, key=name_for_sid)
+        if self.user_columns == 'used':
+            all_users = sorted(user_data,
+                               key=lambda sid: (user_data[sid]['name'], sid))
+
+        options = [""] + all_users
+
+        positions = ats.positions(result['id'] for result in results)
 
         for result in results:
-            ticket = Ticket(self.env, result['id'])
             filtered_result = dict((k, v)
                                    for k, v in result.iteritems()
                                    if k in fields)
-            filtered_result['position'] = ats.position(result['id'])
+            filtered_result['position'] = positions[result['id']]
             filtered_result['_changetime'] = to_utimestamp(result['changetime'])
             # we use Trac's to_json() (through add_script_data), so
             # we'll replace any types which can't be json serialised
             for k, v in filtered_result.items():
                 if isinstance(v, datetime): filtered_result[k] = pretty_age(v)
-            group_field_val = ticket.get_value_or_default(field["name"]) or ""
+            group_field_val = group_values[result["id"]]
             tickets_json[group_field_val][result["id"]] = filtered_result
 
         return (field["name"], tickets_json, options, user_data)
 
+    def _get_group_values(self, results, field, chunk_size=500):
+        """Return a dict of the value of `field` each query result is
+        grouped under, as `Ticket.get_value_or_default` would give it.
+
+        The query turns NULL into '', so the values are read again here:
+        only NULL gets the field's default, and an empty value stays empty.
+        """
+        ids = [result['id'] for result in results]
+        values = dict((id_, "") for id_ in ids)
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        if field.get("custom"):
+            rows = chunked_in(cursor, """
+                SELECT ticket, value FROM ticket_custom
+                WHERE name=%%s AND ticket IN (%s)
+                """, ids, chunk_size, [field["name"]])
+        else:
+            rows = chunked_in(cursor,
+                              "SELECT id, %s FROM ticket WHERE id IN (%%s)"
+                              % db.quote(field["name"]), ids, chunk_size)
+        for id_, value in rows:
+            if value is None:
+                value = field.get("value")
+            values[id_] = value or ""
+        return values
+
     def _get_status_data(self, req, milestone, field, results, fields):
         """Get data grouped by WORKFLOW and status.
 
@@ -425,6 +509,7 @@ class TaskboardModule(Component):
         We then get the workflow with the most tickets, and show that first"""
         ats = AgileToolsSystem(self.env)
         loc = LogicaOrderController(self.env)
+        workflows = WorkflowCatalogue(self.env)
 
         # Data for status much more complex as we need to track the workflow
         tickets_json = defaultdict(lambda: defaultdict(dict))
@@ -436,29 +521,38 @@ class TaskboardModule(Component):
         # E.g. closing a ticket requires a resolution
         act_controls = {}
 
+        # The workflow follows from the ticket type, and the state in it
+        # from the status, so tickets with the same type and status share
+        # their actions. Only one ticket of each is loaded to work them out.
+        actions_for_status = {}
+
+        positions = ats.positions(r['id'] for r in results)
+
         for r in results:
             # Increment type statistics
             by_type[r['type']] += 1
-            tkt = Ticket(self.env, r['id'])
             if r['type'] not in wf_for_type:
-                wf_for_type[r['type']] = \
-                    loc._get_workflow_for_typename(r['type'])
+                wf_for_type[r['type']] = workflows.workflow(r['type'])
             wf = wf_for_type[r['type']]
 
-            state = loc._determine_workflow_state(tkt, req=req)
-            op = Operation(self.env, wf, state)
+            if (r['type'], r['status']) not in actions_for_status:
+                tkt = Ticket(self.env, r['id'])
+                state = loc._determine_workflow_state(tkt, req=req)
+                op = Operation(self.env, wf, state)
+                actions = self._get_status_actions(req, op, wf, state)
+                actions_for_status[r['type'], r['status']] = actions
+                # Collect all actions requiring further input
+                self._update_controls(req, act_controls, actions, tkt)
             filtered = dict((k, v)
                             for k, v in r.iteritems()
                             if k in fields)
-            filtered['position'] = ats.position(r['id'])
+            filtered['position'] = positions[r['id']]
             filtered['_changetime'] = to_utimestamp(r['changetime'])
             # we use Trac's to_json() (through add_script_data), so
             # we'll replace any types which can't be json serialised
             for k, v in filtered.items():
                 if isinstance(v, datetime): filtered[k] = pretty_age(v)
-            filtered['actions'] = self._get_status_actions(req, op, wf, state)
-            # Collect all actions requiring further input
-            self._update_controls(req, act_controls, filtered['actions'], tkt)
+            filtered['actions'] = actions_for_status[r['type'], r['status']]
 
             tickets_json[wf.name][r["status"]][r["id"]] = filtered
 
@@ -480,6 +574,41 @@ class TaskboardModule(Component):
         show_first = max(by_wf, key=lambda n: by_wf[n]).name
         return ("status", tickets_json, wf_statuses, status_limits, show_first, act_controls)
 
+    def _response_state(self, milestone, grouped_by):
+        """Return what the ticket data grouped by `grouped_by` depends on
+        besides the tickets themselves, to go into the entity tag.
+
+        The display names of users who aren't in a permission group are left
+        out, so a change to one of those is only shown once a ticket on the
+        board changes or the board is reloaded.
+        """
+        fields = self._fields()
+        group_by = fields.grouping_by_name.get(grouped_by) \
+                   or fields.grouping_by_name.get("status")
+
+        if group_by["name"] == "status":
+            workflows = WorkflowCatalogue(self.env)
+            statuses = [(type_, workflows.workflow(type_).name,
+                         workflows.workflow(type_).ordered_statuses)
+                        for type_ in fields.types]
+            db = self.env.get_read_db()
+            cursor = db.cursor()
+            cursor.execute("""
+                SELECT status, hardlimit FROM kanban_limits
+                WHERE milestone = %s ORDER BY status""", (milestone,))
+            return [statuses, sorted(workflows.closed_statuses().items()),
+                    cursor.fetchall()]
+
+        if group_by["name"] in self.user_fields:
+            use_avatar = self.config.get('avatar','mode').lower() != 'off'
+            if self.user_columns == 'used':
+                return [self.user_columns, use_avatar]
+            user_data, sids = UserDirectory(self.env).group_members()
+            return [self.user_columns, use_avatar,
+                    [(sid, user_data[sid]['name']) for sid in sids]]
+
+        return [group_by.get("options")]
+
     def _get_status_actions(self, req, op, workflow, state):
         """Get all statuses a ticket can move to, and the actions for each."""
         actions = {}
@@ -1,10 +1,18 @@
 import unittest
 
-from agiletools.tests import positioning
+from agiletools.tests import (backlog, concurrency, milestones, permissions,
+                              positioning, taskboard, users, workflows)
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(positioning.suite())
+    suite.addTest(concurrency.suite())
+    suite.addTest(users.suite())
+    suite.addTest(permissions.suite())
+    suite.addTest(milestones.suite())
+    suite.addTest(backlog.suite())
+    suite.addTest(taskboard.suite())
+    suite.addTest(workflows.suite())
 
     return suite
 
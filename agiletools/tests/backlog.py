@@ -0,0 +1,258 @@
+import json
+import unittest
+from datetime import datetime, timedelta
+
+from trac.perm import PermissionCache, PermissionSystem
+from trac.test import EnvironmentStub, Mock
+from trac.util.datefmt import to_utimestamp, utc
+from trac.web.api import _RequestArgs
+
+from agiletools.api import AgileToolsSystem
+from agiletools.backlog import BacklogModule
+from agiletools.tests.permissions import OddTicketsPolicy
+
+from trac.ticket.api import TicketSystem
+from trac.ticket.model import Ticket
+
+class BacklogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'agiletools.*',
+                                           OddTicketsPolicy],
+                                   default_data=True)
+        self.env.config.set('ticket-custom', 'remaininghours', 'text')
+        self.env.config.set('ticket-custom', 'effort', 'text')
+        TicketSystem(self.env).reset_ticket_fields()
+        AgileToolsSystem(self.env).environment_created()
+        self.bm = BacklogModule(self.env)
+
+    def _req(self, username='anonymous'):
+        return Mock(authname=username, perm=PermissionCache(self.env, username),
+                    href=self.env.href, tz=utc, locale=None, lc_time=None,
+                    args={})
+
+    def _insert(self, milestone, count, **values):
+        for i in range(count):
+            ticket = Ticket(self.env)
+            ticket.populate(dict(values, summary='Ticket %d' % i,
+                                 milestone=milestone))
+            ticket.insert()
+
+    def test_missing_tickets(self):
+        for i in range(3):
+            Ticket(self.env).insert()
+        self.assertEqual([], self.bm._missing_tickets([1, 2, 3, 2]))
+        self.assertEqual([0, 4], self.bm._missing_tickets([4, 1, 0]))
+        self.assertEqual([0, 4], self.bm._missing_tickets([4, 1, 0],
+                                                          chunk_size=1))
+
+    def test_permitted_tickets_window(self):
+        self._insert('milestone1', 5)
+        self._insert('milestone2', 2)
+        req = self._req()
+        ids = [r['id'] for r in self.bm._get_permitted_tickets(req,
+                                            {'milestone': ['milestone1']})]
+        self.assertEqual(5, len(ids))
+        pages = [[r['id'] for r in self.bm._get_permitted_tickets(req,
+                                    {'milestone': ['milestone1']}, offset, 2)]
+                 for offset in (0, 2, 4)]
+        self.assertEqual([ids[0:2], ids[2:4], ids[4:]], pages)
+        # All tickets fit in one page
+        self.assertEqual(ids[1:], [r['id'] for r in
+                         self.bm._get_permitted_tickets(req,
+                                    {'milestone': ['milestone1']}, 1, 10)])
+
+    def _loaded_totals(self, req, milestones):
+        return dict((name, self.bm._get_totals(self.bm._get_permitted_tickets(
+                        req, {'milestone': [name]})))
+                    for name in milestones)
+
+    def test_milestone_totals(self):
+        self._insert('milestone1', 3, remaininghours='2', effort='5')
+        self._insert('milestone1', 2, remaininghours='1.5')
+        self._insert('milestone1', 1, remaininghours='n/a', effort='')
+        self._insert('milestone1', 2, type='defect', status='closed',
+                     remaininghours='4')
+        self._insert('milestone2', 1, effort='0.5')
+        self._insert('', 2, remaininghours='1')
+        names = ['milestone1', 'milestone2', '', 'milestone3']
+        req = self._req()
+
+        totals = self.bm._get_milestone_totals(req, names)
+        self.assertEqual(self._loaded_totals(req, names), totals)
+        self.assertEqual({'tickets': 6, 'hours': 9, 'effort': 15},
+                         totals['milestone1'])
+        self.assertEqual({'tickets': 0, 'hours': 0, 'effort': 0},
+                         totals['milestone3'])
+
+        # Only the tickets the user may view are counted
+        self.env.config.set('trac', 'permission_policies',
+                            'OddTicketsPolicy, DefaultPermissionPolicy')
+        req = self._req()
+        self.assertEqual(self._loaded_totals(req, names),
+                         self.bm._get_milestone_totals(req, names))
+        self.assertNotEqual(totals, self.bm._get_milestone_totals(req, names))
+
+    def test_milestone_totals_not_viewable(self):
+        self._insert('milestone1', 2, remaininghours='2')
+        PermissionSystem(self.env).revoke_permission('anonymous',
+                                                     'TICKET_VIEW')
+        self.assertEqual({'milestone1': {'tickets': 0, 'hours': 0,
+                                         'effort': 0}},
+                         self.bm._get_milestone_totals(self._req(),
+                                                       ['milestone1']))
+
+    def test_totals_only(self):
+        self._insert('milestone1', 3, remaininghours='2', effort='5')
+        self._insert('milestone2', 1, effort='0.5')
+        sent = []
+        # BACKLOG_VIEW is defined by another plugin
+        perm = Mock(PermissionCache, self.env, 'anonymous',
+                    assert_permission=lambda action: None)
+        req = Mock(authname='anonymous', perm=perm, method='GET',
+                   args=_RequestArgs(milestones=['milestone1', 'milestone2'],
+                                     limit='0'),
+                   get_header=lambda name: 'XMLHttpRequest',
+                   check_modified=lambda dt, extra: None,
+                   send=lambda content, content_type:
+                       sent.append(json.loads(content)))
+
+        def get_permitted_tickets(*args, **kwargs):
+            self.fail("Tickets were loaded for the totals")
+        self.bm._get_permitted_tickets = get_permitted_tickets
+        self.bm.process_request(req)
+        self.assertEqual({'milestones': {
+            'milestone1': {'total': 3,
+                           'totals': {'tickets': 3, 'hours': 6,
+                                      'effort': 15}},
+            'milestone2': {'total': 1,
+                           'totals': {'tickets': 1, 'hours': 0,
+                                      'effort': 0.5}}}}, sent[0])
+
+    def test_other_changes(self):
+        t0 = datetime(2015, 1, 1, tzinfo=utc)
+        before = t0 + timedelta(minutes=30)
+        start, end = t0 + timedelta(hours=1), t0 + timedelta(hours=2)
+        for i in range(4):
+            ticket = Ticket(self.env)
+            ticket.populate({'summary': 'Ticket %d' % i,
+                             'milestone': 'milestone1'})
+            ticket.insert(when=t0)
+        for id_, milestone, when in [(1, 'milestone2', start),
+                                     (2, 'milestone3', start),
+                                     (3, 'milestone3', end),
+                                     (4, 'milestone3', before)]:
+            ticket = Ticket(self.env, id_)
+            ticket['milestone'] = milestone
+            ticket.save_changes('joe', '', when=when)
+
+        req = self._req()
+        changed = self.bm._get_permitted_tickets(req, {
+            'milestone': ['milestone1', 'milestone2'],
+            'changetime': ['%s..%s' % (start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                       end.strftime('%Y-%m-%dT%H:%M:%SZ'))]})
+        self.assertEqual([1], [r['id'] for r in changed])
+        # Ticket 2 left the milestones in the period
+        self.assertEqual([2], AgileToolsSystem(self.env).other_changes(req,
+            [r['id'] for r in changed], start, end))
+
+class SaveTicketsTestCase(unittest.TestCase):
+    """Saving several tickets at once writes the same rows as saving each
+    with `Ticket.save_changes`: tickets 1-3 are saved together and their
+    copies 4-6 one by one."""
+
+    t0 = datetime(2015, 1, 1, tzinfo=utc)
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'agiletools.*'],
+                                   default_data=True)
+        self.env.config.set('ticket-custom', 'effort', 'text')
+        TicketSystem(self.env).reset_ticket_fields()
+        AgileToolsSystem(self.env).environment_created()
+        PermissionSystem(self.env).grant_permission('admin', 'TICKET_ADMIN')
+        self.bm = BacklogModule(self.env)
+        for copy in range(2):
+            for i in range(3):
+                ticket = Ticket(self.env)
+                ticket.populate({'summary': 'Ticket %d' % i,
+                                 'reporter': 'joe', 'milestone': 'milestone2'})
+                if i == 0:
+                    ticket['effort'] = '2'
+                ticket.insert(when=self.t0)
+            # A comment was made before, so the comment numbers differ
+            ticket = Ticket(self.env, copy * 3 + 2)
+            ticket.save_changes('joe', 'Comment',
+                                when=self.t0 + timedelta(seconds=1))
+
+    def _req(self):
+        return Mock(authname='admin', perm=PermissionCache(self.env, 'admin'),
+                    args={}, chrome={'warnings': [], 'notices': []},
+                    method='POST', href=self.env.href, tz=utc, locale=None,
+                    lc_time=None)
+
+    def _changetime(self, id_):
+        return str(to_utimestamp(Ticket(self.env, id_)['changetime']))
+
+    def _saved_at(self):
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT MAX(time) FROM ticket_change")
+        return datetime.fromtimestamp(cursor.fetchone()[0] / 1000000.0, utc)
+
+    def _rows(self, ids):
+        """Return the ticket, ticket_custom and ticket_change rows of the
+        tickets with `ids`, numbered from 0 in place of their ids."""
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        index = dict((id_, i) for i, id_ in enumerate(ids))
+        holders = ",".join(["%s"] * len(ids))
+        rows = []
+        for sql in ("SELECT * FROM ticket WHERE id IN (%s)",
+                    "SELECT * FROM ticket_custom WHERE ticket IN (%s)",
+                    "SELECT * FROM ticket_change WHERE ticket IN (%s)"):
+            cursor.execute(sql % holders, ids)
+            rows.append(sorted((index[row[0]],) + tuple(row[1:])
+                               for row in cursor))
+        return rows
+
+    def test_save_tickets(self):
+        # Ticket 99 doesn't exist, and ticket 3 was changed meanwhile
+        changetimes = [self._changetime(1), self._changetime(2), '1', '1']
+        errors = self.bm._save_tickets(self._req(), [1, 2, 99, 3],
+                                       'milestone1', changetimes)
+        self.assertEqual([99, 3], [error[0] for error in errors])
+        self.assertEqual(["Not a valid ticket"], errors[0][1])
+
+        when = self._saved_at()
+        for id_ in (4, 5):
+            ticket = Ticket(self.env, id_)
+            ticket['milestone'] = 'milestone1'
+            ticket.save_changes('admin', '', when=when)
+        self.assertEqual(self._rows([1, 2, 3]), self._rows([4, 5, 6]))
+        self.assertEqual('milestone2', Ticket(self.env, 3)['milestone'])
+
+    def test_save_changes(self):
+        when = self.t0 + timedelta(days=1)
+        tickets = self.bm._load_tickets([1, 2, 3])
+        for id_, ticket in tickets.iteritems():
+            ticket['effort'] = str(id_)
+            ticket['milestone'] = ''
+        tickets[3]['summary'] = 'Changed'
+        self.bm._save_changes(tickets.values(), 'admin', when)
+
+        for id_ in (4, 5, 6):
+            ticket = Ticket(self.env, id_)
+            ticket['effort'] = str(id_ - 3)
+            ticket['milestone'] = ''
+            if id_ == 6:
+                ticket['summary'] = 'Changed'
+            ticket.save_changes('admin', '', when=when)
+        self.assertEqual(self._rows([1, 2, 3]), self._rows([4, 5, 6]))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(BacklogTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SaveTicketsTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest="suite")
@@ -0,0 +1,182 @@
+import os
+import unittest
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from trac.env import Environment
+
+from agiletools import db_default
+from agiletools.api import AgileToolsSystem
+
+from trac.ticket.model import Ticket
+
+class ConcurrentMoveTestCase(unittest.TestCase):
+    """Moves tickets from several threads at once. Run this module with
+    `benchmark` as its argument to see the moves per second instead.
+
+    An in-memory EnvironmentStub database isn't shared between threads, so
+    these tests use an environment with an SQLite file instead. Half of the
+    threads go through a second environment opened on the same directory,
+    which behaves like a second server process.
+    """
+    tickets = 40
+    threads = 4
+    moves_per_thread = 50
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='agiletools-')
+        options = [('components', 'agiletools.*', 'enabled'),
+                   ('trac', 'database', 'sqlite:db/trac.db')]
+        self.env = Environment(os.path.join(self.path, 'env'), create=True,
+                               options=options)
+        self.other_env = Environment(self.env.path)
+        self.ts = AgileToolsSystem(self.env)
+        for i in range(self.tickets):
+            Ticket(self.env).insert()
+
+    def tearDown(self):
+        self.other_env.shutdown()
+        self.env.shutdown()
+        shutil.rmtree(self.path)
+
+    def _positions(self):
+        cursor = self.env.get_read_db().cursor()
+        cursor.execute("SELECT ticket, position FROM ticket_positions")
+        return dict(cursor.fetchall())
+
+    def _generation(self):
+        cursor = self.env.get_read_db().cursor()
+        cursor.execute("SELECT value FROM system WHERE name = %s",
+                       (db_default.generation_name, ))
+        row = cursor.fetchone()
+        return int(row[0]) if row else 0
+
+    def _run_movers(self, groups=None):
+        """Move tickets from several threads and return the seconds taken.
+        With `groups`, a list of lists of ticket ids, each thread only moves
+        the tickets of one of them."""
+        errors = []
+        if groups is None:
+            groups = [range(1, self.tickets + 1)]
+
+        def mover(seed):
+            rnd = random.Random(seed)
+            ts = AgileToolsSystem((self.env, self.other_env)[seed % 2])
+            group = groups[seed % len(groups)]
+            try:
+                for i in range(self.moves_per_thread):
+                    ticket = rnd.choice(group)
+                    relative = rnd.choice(group)
+                    if ticket == relative:
+                        continue
+                    position = ts.position(relative, generate=True)
+                    if rnd.random() < 0.5:
+                        position += 1
+                    ts.move(ticket, position, author='user%d' % seed)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=mover, args=(seed, ))
+                   for seed in range(self.threads)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        self.assertEqual(errors, [])
+        return elapsed
+
+    def test_concurrent_dense_moves(self):
+        self._run_movers()
+
+        positions = self._positions()
+        # Every ticket that was touched has exactly one position, and
+        # positions stay dense without duplicates or holes
+        self.assertEqual(sorted(positions.values()), range(len(positions)))
+
+    def test_concurrent_sparse_moves(self):
+        for env in (self.env, self.other_env):
+            env.config.set('agiletools', 'position_gap', 8)
+        self._run_movers()
+
+        positions = self._positions()
+        self.assertEqual(len(set(positions.values())), len(positions))
+
+    def test_concurrent_moves_in_milestones(self):
+        for env in (self.env, self.other_env):
+            env.config.set('agiletools', 'position_scope', 'milestone')
+        groups = {'milestone1': range(1, self.tickets // 2 + 1),
+                  'milestone2': range(self.tickets // 2 + 1,
+                                      self.tickets + 1)}
+        for milestone, ids in groups.iteritems():
+            for id_ in ids:
+                ticket = Ticket(self.env, id_)
+                ticket['milestone'] = milestone
+                ticket.save_changes('joe', '')
+        generation = self._generation()
+        self._run_movers(groups.values())
+
+        # Each milestone keeps its own dense positions
+        positions = self._positions()
+        for milestone, ids in groups.iteritems():
+            self.assertEqual(sorted(positions[id_] for id_ in ids
+                                    if id_ in positions),
+                             range(len([id_ for id_ in ids
+                                        if id_ in positions])))
+
+        # Moves only lock and count in their own milestone
+        cursor = self.env.get_read_db().cursor()
+        cursor.execute("SELECT name, value FROM system WHERE name LIKE %s",
+                       (db_default.generation_name + ':%', ))
+        counts = dict((name, int(value)) for name, value in cursor)
+        self.assertEqual(sorted(db_default.generation_name + ':' + milestone
+                                for milestone in groups), sorted(counts))
+        self.assertTrue(all(counts.values()))
+        self.assertEqual(generation, self._generation())
+
+    def test_generation_per_move(self):
+        self.ts.backfill()
+        generation = self._generation()
+
+        self.ts.move(3, 0)
+        self.assertEqual(self._generation(), generation + 1)
+
+        # Not a move, so nothing is written
+        self.ts.move(3, 0)
+        self.assertEqual(self._generation(), generation + 1)
+
+        self.ts.move_many([(5, 0), (6, 0)])
+        self.assertEqual(self._generation(), generation + 2)
+        self.assertEqual(sorted(self._positions(), key=self._positions().get)[:3],
+                         [5, 6, 3])
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ConcurrentMoveTestCase, 'test'))
+    return suite
+
+def benchmark():
+    """Print the moves per second with dense and with sparse positions."""
+    for gap in (1, 8):
+        case = ConcurrentMoveTestCase('test_concurrent_dense_moves')
+        case.setUp()
+        try:
+            for env in (case.env, case.other_env):
+                env.config.set('agiletools', 'position_gap', gap)
+            elapsed = case._run_movers()
+        finally:
+            case.tearDown()
+        moves = case.threads * case.moves_per_thread
+        print "%d threads: %d moves in %.2fs (%.1f moves/sec, gap %d)" % (
+            case.threads, moves, elapsed, moves / max(elapsed, 1e-6), gap)
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['benchmark']:
+        benchmark()
+    else:
+        unittest.main(defaultTest="suite")
@@ -0,0 +1,39 @@
+import unittest
+from trac.test import EnvironmentStub
+from trac.ticket.model import Milestone
+
+from agiletools.milestones import MilestoneCatalogue
+
+class MilestoneCatalogueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'agiletools.*'], default_data=True)
+        self.catalogue = MilestoneCatalogue(self.env)
+
+    def test_exists(self):
+        self.assertTrue(self.catalogue.exists('milestone1'))
+        self.assertFalse(self.catalogue.exists('sprint1'))
+        self.assertFalse(self.catalogue.exists(''))
+
+    def test_reset_on_change(self):
+        self.assertFalse(self.catalogue.exists('sprint1'))
+
+        milestone = Milestone(self.env)
+        milestone.name = 'sprint1'
+        milestone.insert()
+        self.assertTrue(self.catalogue.exists('sprint1'))
+
+        milestone.name = 'sprint2'
+        milestone.update()
+        self.assertFalse(self.catalogue.exists('sprint1'))
+        self.assertTrue(self.catalogue.exists('sprint2'))
+
+        milestone.delete()
+        self.assertFalse(self.catalogue.exists('sprint2'))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MilestoneCatalogueTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest="suite")
@@ -0,0 +1,57 @@
+import unittest
+from trac.core import Component, implements
+from trac.perm import IPermissionPolicy, PermissionCache, PermissionSystem
+from trac.test import EnvironmentStub, Mock
+
+from agiletools.api import AgileToolsSystem
+
+class OddTicketsPolicy(Component):
+    """Denies viewing tickets with odd ids."""
+
+    implements(IPermissionPolicy)
+
+    def check_permission(self, action, username, resource, perm):
+        if resource and resource.realm == 'ticket' and resource.id % 2:
+            return False
+
+class ViewableTicketsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'agiletools.*',
+                                           OddTicketsPolicy])
+        self.ts = AgileToolsSystem(self.env)
+        self.results = [{'id': i} for i in range(1, 7)]
+        PermissionSystem(self.env).grant_permission('viewer', 'TICKET_VIEW')
+
+    def _req(self, username):
+        return Mock(perm=PermissionCache(self.env, username))
+
+    def test_resource_independent_policies(self):
+        self.assertEqual(self.results,
+                         self.ts.viewable_tickets(self._req('viewer'),
+                                                  self.results))
+        self.assertEqual([],
+                         self.ts.viewable_tickets(self._req('other'),
+                                                  self.results))
+
+    def test_resource_specific_policy(self):
+        self.env.config.set('trac', 'permission_policies',
+                            'OddTicketsPolicy, DefaultPermissionPolicy')
+        self.assertEqual([2, 4, 6],
+                         [r['id'] for r in self.ts.viewable_tickets(
+                             self._req('viewer'), self.results)])
+
+    def test_permission_for_all(self):
+        self.assertTrue(self.ts.permission_for_all(self._req('viewer')))
+        self.assertFalse(self.ts.permission_for_all(self._req('other')))
+        self.env.config.set('trac', 'permission_policies',
+                            'OddTicketsPolicy, DefaultPermissionPolicy')
+        self.assertEqual(None,
+                         self.ts.permission_for_all(self._req('viewer')))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ViewableTicketsTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest="suite")
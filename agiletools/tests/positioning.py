@@ -1,9 +1,12 @@
 import unittest
 import random
+from datetime import datetime, timedelta
 from trac.core import Component, implements
 from trac.test import EnvironmentStub, Mock
+from trac.util.datefmt import utc
 
-from agiletools.api import AgileToolsSystem
+from agiletools import db_default
+from agiletools.api import AgileToolsSystem, _Scope
 
 from trac.ticket.query import Query
 from trac.ticket.model import Ticket
@@ -131,6 +134,503 @@ class PositioningTestCase(unittest.TestCase):
         if None not in final_positions:
             self.assertEqual(final_positions, tickets_range)
 
+    def test_bulk_positions(self):
+        for i in range(5):
+            Ticket(self.env).insert()
+
+        self.ts.move(3, 0)
+        self.ts.move(5, 0)
+        self.assertEqual({1: None, 3: 1, 5: 0, 42: None},
+                         self.ts.positions([1, 3, 5, 42]))
+        self.assertEqual({3: 1, 5: 0},
+                         self.ts.positions(["3", 5], chunk_size=1))
+        self.assertEqual({}, self.ts.positions([]))
+
+    def test_backfill(self):
+        ticket_priorities = ["minor", "major", "blocker", "critical", "minor"]
+        for priority in ticket_priorities:
+            ticket = Ticket(self.env)
+            ticket["priority"] = priority
+            ticket.insert()
+        self.ts.move(1, 0)
+
+        self.env.config.set('agiletools', 'backfill_batch_size', 2)
+        self.assertEqual(1, self.ts.backfill(limit=1))
+        self.assertEqual({1: 0, 2: None, 3: 1, 4: None, 5: None},
+                         self.ts.positions(range(1, 6)))
+
+        # Resumes where the previous run stopped
+        self.assertEqual(3, self.ts.backfill())
+        self.assertEqual({1: 0, 2: 3, 3: 1, 4: 2, 5: 4},
+                         self.ts.positions(range(1, 6)))
+        self.assertEqual(0, self.ts.backfill())
+
+        # Ordering is the same as before the backfill
+        self.assertEqual([r['id'] for r in Query(self.env).execute(self.req)],
+                         [1,3,4,2,5])
+
+        # Once every ticket is positioned new tickets go to the end
+        ticket = Ticket(self.env)
+        ticket["priority"] = "blocker"
+        ticket.insert()
+        self.assertEqual(5, self.ts.position(6))
+
+    def test_new_ticket_waits_for_backfill(self):
+        for i in range(3):
+            Ticket(self.env).insert()
+        self.ts.move(2, 0)
+
+        # Still in the order of the unpositioned tickets
+        Ticket(self.env).insert()
+        self.assertEqual(None, self.ts.position(4))
+        self.ts.backfill()
+        self.assertEqual({1: 1, 2: 0, 3: 2, 4: 3},
+                         self.ts.positions(range(1, 5)))
+
+    def test_generate_is_bounded(self):
+        for i in range(6):
+            Ticket(self.env).insert()
+        self.ts.move(1, 0)
+        self.env.config.set('agiletools', 'backfill_batch_size', 2)
+
+        # Ticket 6 is out of reach of one batch, so it points past the
+        # tickets positioned so far
+        self.assertEqual(3, self.ts.position(6, generate=True))
+        self.assertEqual({1: 0, 2: 1, 3: 2, 4: None, 5: None, 6: None},
+                         self.ts.positions(range(1, 7)))
+
+        self.assertEqual(3, self.ts.position(4, generate=True))
+
+    def _test_move_many(self):
+        for i in range(8):
+            Ticket(self.env).insert()
+        order = lambda: [r['id'] for r in Query(self.env).execute(self.req)]
+
+        # Several tickets in front of the same ticket keep their order
+        self.ts.move_many([(6, self.ts.position(2, generate=True)),
+                           (4, self.ts.position(2, generate=True)),
+                           (8, self.ts.position(2, generate=True))])
+        self.assertEqual(order(), [1,6,4,8,2,3,5,7])
+
+        # Positions are relative to the ordering before the batch
+        self.ts.backfill()
+        self.ts.move_many([(1, self.ts.position(3)),
+                           (3, self.ts.position(6)),
+                           (7, self.ts.position(1))])
+        self.assertEqual(order(), [3,7,6,4,8,2,1,5])
+
+        # Moving to the end, and the same ticket twice
+        self.ts.move_many([(6, self.ts.position(5) + 1),
+                           (7, self.ts.position(5) + 1),
+                           (6, self.ts.position(3))])
+        self.assertEqual(order(), [6,3,4,8,2,1,5,7])
+
+        positions = self.ts.positions(range(1, 9))
+        self.assertEqual(8, len(set(positions.values())))
+
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT COUNT(*) FROM ticket_positions_change")
+        self.assertEqual(8, cursor.fetchone()[0])
+
+    def test_move_many(self):
+        self._test_move_many()
+        self.assertEqual(range(8),
+                         sorted(self.ts.positions(range(1, 9)).values()))
+
+    def test_sparse_move_many(self):
+        self.env.config.set('agiletools', 'position_gap', 4)
+        self._test_move_many()
+
+    def test_position_history(self):
+        for i in range(3):
+            Ticket(self.env).insert()
+
+        day = datetime(2015, 3, 2, 9, tzinfo=utc)
+        self.ts.move(1, 0, author='alice', when=day)
+        self.ts.move(2, 0, author='bob', when=day + timedelta(hours=1))
+        self.ts.move(1, 0, author='bob', when=day + timedelta(hours=2))
+        self.ts.move(1, 5, author='carol', when=day + timedelta(days=1))
+
+        self.assertEqual([(day, 'alice', None, 0),
+                          (day + timedelta(hours=2), 'bob', 1, 0),
+                          (day + timedelta(days=1), 'carol', 0, 4)],
+                         self.ts.position_history(1))
+        self.assertEqual([1, 1], [move[0] for move in
+                                  self.ts.moves_since(day + timedelta(hours=1))])
+
+        # Only the first day is old enough to be compacted
+        self.assertEqual(1, self.ts.compact_history(before=day + timedelta(days=1)))
+        self.assertEqual([(day + timedelta(hours=2), 'bob', None, 0),
+                          (day + timedelta(days=1), 'carol', 0, 4)],
+                         self.ts.position_history(1))
+        self.assertEqual(1, len(self.ts.position_history(2)))
+
+        # Running again resumes after the compacted day
+        self.assertEqual(0, self.ts.compact_history(before=day + timedelta(days=1)))
+        self.assertEqual(0, self.ts.compact_history(before=day + timedelta(days=3)))
+        self.assertEqual(2, len(self.ts.position_history(1)))
+
+    def test_renumber(self):
+        for i in range(7):
+            Ticket(self.env).insert()
+        for ticket, position in zip([4, 2, 7, 1, 3], [-50, 3, 3000, 4000, 4001]):
+            self.ts.move(ticket, position)
+
+        self.assertEqual(5, self.ts.renumber(batch=2))
+        self.assertEqual({1: 3, 2: 1, 3: 4, 4: 0, 5: None, 6: None, 7: 2},
+                         self.ts.positions(range(1, 8)))
+
+        self.assertEqual(5, self.ts.renumber(gap=100, batch=3))
+        self.assertEqual({1: 300, 2: 100, 3: 400, 4: 0, 5: None, 6: None, 7: 200},
+                         self.ts.positions(range(1, 8)))
+
+    def test_upgrade_adds_generation(self):
+        @self.env.with_transaction()
+        def do_downgrade(db):
+            cursor = db.cursor()
+            cursor.execute("DELETE FROM system WHERE name = %s",
+                           (db_default.generation_name, ))
+            cursor.execute("UPDATE system SET value = '5' WHERE name = %s",
+                           (db_default.name, ))
+
+        db = self.env.get_db_cnx()
+        self.assertTrue(self.ts.environment_needs_upgrade(db))
+        self.ts.upgrade_environment(db)
+        self.assertFalse(self.ts.environment_needs_upgrade(db))
+
+        for i in range(2):
+            Ticket(self.env).insert()
+        self.ts.move(2, 0)
+        self.assertEqual(1, self.ts._generation(db.cursor()))
+
+    def test_renumber_interrupted(self):
+        for i in range(6):
+            Ticket(self.env).insert()
+        for ticket in range(1, 7):
+            self.ts.move(ticket, 100000 + ticket * 10)
+
+        def order():
+            positions = self.ts.positions(range(1, 7))
+            return sorted(positions, key=positions.get)
+
+        # Stop after a few of the transactions
+        write_positions = self.ts._write_positions
+        writes = []
+        def interrupted(fn):
+            if len(writes) == 4:
+                raise KeyboardInterrupt()
+            writes.append(fn)
+            return write_positions(fn)
+        self.ts._write_positions = interrupted
+        self.assertRaises(KeyboardInterrupt, self.ts.renumber, batch=2)
+        self.assertEqual(4, len(writes))
+        self.assertEqual([1, 2, 3, 4, 5, 6], order())
+
+        self.ts._write_positions = write_positions
+        self.assertEqual(6, self.ts.renumber(gap=10, batch=2))
+        self.assertEqual({1: 0, 2: 10, 3: 20, 4: 30, 5: 40, 6: 50},
+                         self.ts.positions(range(1, 7)))
+
+    def _sparse_positions(self):
+        db = self.env.get_read_db()
+        cursor = db.cursor()
+        cursor.execute("SELECT ticket, position FROM ticket_positions")
+        return dict(cursor.fetchall())
+
+    def test_sparse_relative_move(self):
+        self.env.config.set('agiletools', 'position_gap', 1024)
+
+        for i in range(6):
+            Ticket(self.env).insert()
+
+        self.ts.move(4, self.ts.position(1, generate=True))
+        self.assertEqual([r['id'] for r in Query(self.env).execute(self.req)],
+                         [4,1,2,3,5,6])
+
+        self.ts.move(4, self.ts.position(3, generate=True))
+        self.assertEqual([r['id'] for r in Query(self.env).execute(self.req)],
+                         [1,2,4,3,5,6])
+
+        self.ts.move(1, self.ts.position(6, generate=True))
+        self.assertEqual([r['id'] for r in Query(self.env).execute(self.req)],
+                         [2,4,3,5,1,6])
+
+        self.ts.move(2, self.ts.position(1, generate=True) + 1)
+        self.assertEqual([r['id'] for r in Query(self.env).execute(self.req)],
+                         [4,3,5,1,2,6])
+
+    def test_sparse_move_touches_one_row(self):
+        self.env.config.set('agiletools', 'position_gap', 1024)
+
+        for i in range(5):
+            Ticket(self.env).insert()
+        self.ts.position(5, generate=True)
+        before = self._sparse_positions()
+        self.assertEqual([0, 1024, 2048, 3072, 4096],
+                         [before[t] for t in range(1, 6)])
+
+        self.ts.move(5, self.ts.position(2))
+        after = self._sparse_positions()
+        self.assertEqual(512, after[5])
+        del before[5], after[5]
+        self.assertEqual(before, after)
+
+    def test_sparse_rebalance(self):
+        self.env.config.set('agiletools', 'position_gap', 2)
+
+        tickets = 20
+        for i in range(tickets):
+            Ticket(self.env).insert()
+        self.ts.position(tickets, generate=True)
+
+        # Keep inserting in front of the same ticket until the gap is gone
+        order = range(1, tickets + 1)
+        for mover in range(tickets, 10, -1):
+            self.ts.move(mover, self.ts.position(1, generate=True) + 1)
+            order.remove(mover)
+            order.insert(1, mover)
+
+        positions = self._sparse_positions()
+        self.assertEqual(order, sorted(positions, key=positions.get))
+        self.assertEqual(tickets, len(set(positions.values())))
+
+    def test_sparse_rebalance_is_local(self):
+        self.env.config.set('agiletools', 'position_gap', 1024)
+
+        tickets = 200
+        for i in range(tickets):
+            Ticket(self.env).insert()
+        self.ts.position(tickets, generate=True)
+
+        # Dropping after the same ticket again and again only renumbers the
+        # tickets crowded in after it, never the rest of the backlog
+        order = range(1, tickets + 1)
+        for mover in range(tickets, tickets - 20, -1):
+            before = self._sparse_positions()
+            self.ts.move(mover, self.ts.position(1) + 1)
+            after = self._sparse_positions()
+            order.remove(mover)
+            order.insert(1, mover)
+
+            self.assertEqual(order, sorted(after, key=after.get))
+            moved = [t for t in after if after[t] != before[t]]
+            self.assertTrue(len(moved) <= 20, moved)
+
+    def test_open_gap_duplicate_positions(self):
+        self.env.config.set('agiletools', 'position_gap', 1024)
+
+        for i in range(6):
+            Ticket(self.env).insert()
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            cursor.executemany("""
+                INSERT INTO ticket_positions (ticket, position)
+                VALUES (%s, %s)""",
+                [(1, 0), (2, 1), (3, 1), (4, 1), (5, 1), (6, 5000)])
+
+        @self.env.with_transaction()
+        def do_open_gap(db):
+            self.assertEqual(1025, self.ts._open_gap(db.cursor(), [1], 1,
+                                                     _Scope(), batch=2))
+
+        positions = self._sparse_positions()
+        self.assertEqual([1, 2, 3, 4, 5, 6],
+                         sorted(positions, key=positions.get))
+        self.assertEqual(6, len(set(positions.values())))
+
+    def test_milestone_scope(self):
+        self.env.config.set('agiletools', 'position_scope', 'milestone')
+
+        for milestone in ['milestone1'] * 3 + ['milestone2'] * 3:
+            ticket = Ticket(self.env)
+            ticket['milestone'] = milestone
+            ticket.insert()
+        order = lambda milestone: [r['id'] for r in Query(self.env,
+            constraints={'milestone': [milestone]}).execute(self.req)]
+
+        # Each milestone is ranked on its own
+        self.assertEqual(6, self.ts.backfill())
+        self.assertEqual({1: 0, 2: 1, 3: 2, 4: 0, 5: 1, 6: 2},
+                         self.ts.positions(range(1, 7)))
+
+        # Moving within one milestone leaves the other alone
+        self.ts.move(3, self.ts.position(1))
+        self.assertEqual(order('milestone1'), [3,1,2])
+        self.assertEqual({4: 0, 5: 1, 6: 2}, self.ts.positions([4, 5, 6]))
+
+        self.ts.move_many([(6, self.ts.position(4)), (2, self.ts.position(3))])
+        self.assertEqual(order('milestone1'), [2,3,1])
+        self.assertEqual(order('milestone2'), [6,4,5])
+
+        # Moving a ticket to another milestone puts it at the end of it
+        ticket = Ticket(self.env, 3)
+        ticket['milestone'] = 'milestone2'
+        ticket.save_changes('alice', '')
+        self.assertEqual(order('milestone1'), [2,1])
+        self.assertEqual(order('milestone2'), [6,4,5,3])
+        self.assertEqual(3, self.ts.position(3))
+
+    def test_position_cache(self):
+        self.env.config.set('agiletools', 'position_gap', 1024)
+        for i in range(4):
+            Ticket(self.env).insert()
+        self.ts.backfill()
+        cache = self.ts._cache
+
+        self.assertEqual({1: 0, 2: 1024, 3: 2048, 4: 3072},
+                         self.ts.positions(range(1, 5)))
+        hits, misses = cache.hits, cache.misses
+        self.ts.positions(range(1, 5))
+        self.assertEqual((hits + 4, misses), (cache.hits, cache.misses))
+
+        # A move which only writes the moved ticket patches the cache
+        self.ts.move(4, self.ts.position(2))
+        self.assertEqual({1: 0, 2: 1024, 3: 2048, 4: 512},
+                         self.ts.positions(range(1, 5)))
+        self.assertEqual(misses, cache.misses)
+
+        # A move by another process is noticed through the generation
+        @self.env.with_transaction()
+        def do_move(db):
+            cursor = db.cursor()
+            self.ts._claim_generation(cursor)
+            cursor.execute("UPDATE ticket_positions SET position = 4096 "
+                           "WHERE ticket = 1")
+        self.assertEqual(4096, self.ts.position(1))
+
+        # Bounded in size
+        cache.size = 2
+        self.ts.positions(range(1, 5))
+        self.assertEqual(2, len(cache))
+
+    def test_check_modified(self):
+        for milestone in ('milestone1', 'milestone1', 'milestone2'):
+            ticket = Ticket(self.env)
+            ticket['milestone'] = milestone
+            ticket.insert()
+        tags = []
+        req = Mock(authname='anonymous',
+                   check_modified=lambda dt, extra: tags.append((dt, extra)))
+
+        def changed():
+            self.ts.check_modified(req, 'milestone1')
+            return tags[-1] != tags[-2] if len(tags) > 1 else True
+
+        changed()
+        self.assertFalse(changed())
+
+        self.ts.move(2, 0)
+        self.assertTrue(changed())
+
+        # Moving a ticket out of the milestone leaves its other tickets as
+        # they were
+        ticket = Ticket(self.env, 1)
+        ticket['milestone'] = 'milestone2'
+        ticket.save_changes('anonymous', '', when=datetime(2020, 1, 1, tzinfo=utc))
+        self.assertTrue(changed())
+        self.assertFalse(changed())
+
+        # Several milestones at once, counting the tickets in all of them
+        self.ts.check_modified(req, ['milestone2', ''])
+        Ticket(self.env).insert()
+        # Older than the last change, so only the count differs
+        @self.env.with_transaction()
+        def do_age(db):
+            db.cursor().execute("UPDATE ticket SET changetime = 0 "
+                                "WHERE id = 4")
+        self.ts.check_modified(req, ['milestone2', ''])
+        self.assertNotEqual(tags[-2], tags[-1])
+
+        # Only a short token is sent, whatever goes into it
+        self.ts.check_modified(req, 'milestone1', ['x' * 10000])
+        self.assertEqual(40, len(tags[-1][1]))
+
+    def test_positions_if_moved(self):
+        for milestone in ('milestone1', 'milestone1', 'milestone2'):
+            ticket = Ticket(self.env)
+            ticket['milestone'] = milestone
+            ticket.insert()
+        self.ts.backfill()
+        start = datetime.now(utc) - timedelta(seconds=1)
+        end = start + timedelta(hours=1)
+
+        self.assertEqual({}, self.ts.positions_if_moved('milestone1',
+                                                        start, end))
+        # Tickets 1 and 2 were shifted, but only ticket 3 was logged
+        self.ts.move(3, 0)
+        self.assertEqual({1: 1, 2: 2},
+                         self.ts.positions_if_moved('milestone1', start, end))
+        self.assertEqual({3: 0}, self.ts.positions_if_moved('milestone2',
+                                                            start, end))
+        self.ts.move(2, 0)
+        self.assertEqual({1: 2, 2: 0},
+                         self.ts.positions_if_moved('milestone1', start, end))
+        self.assertEqual({}, self.ts.positions_if_moved('milestone1',
+                                                        end, end))
+
+    def test_positions_if_moved_in_range(self):
+        for i in range(10):
+            ticket = Ticket(self.env)
+            ticket['milestone'] = 'milestone1'
+            ticket.insert()
+        self.ts.backfill()
+        start = datetime.now(utc) - timedelta(seconds=1)
+        end = start + timedelta(hours=1)
+
+        # Only the tickets between the old and the new position
+        self.ts.move(6, self.ts.position(3))
+        self.assertEqual({3: 3, 4: 4, 5: 5, 6: 2},
+                         self.ts.positions_if_moved('milestone1', start, end))
+
+        # Ranges of several moves are combined
+        self.ts.move(9, self.ts.position(10))
+        self.assertEqual({3: 3, 4: 4, 5: 5, 6: 2, 9: 8},
+                         self.ts.positions_if_moved('milestone1', start, end))
+
+        # A ticket without a position shifts everything after it
+        ticket = Ticket(self.env)
+        ticket['milestone'] = 'milestone1'
+        ticket.insert()
+        @self.env.with_transaction()
+        def do_unposition(db):
+            db.cursor().execute("DELETE FROM ticket_positions "
+                                "WHERE ticket = 11")
+        self.ts.move(11, self.ts.position(8))
+        self.assertEqual([3, 4, 5, 6, 8, 9, 10, 11],
+                         sorted(self.ts.positions_if_moved('milestone1',
+                                                           start, end)))
+
+    def test_sparse_positions_if_moved(self):
+        self.env.config.set('agiletools', 'position_gap', 2)
+        for i in range(6):
+            ticket = Ticket(self.env)
+            ticket['milestone'] = 'milestone1'
+            ticket.insert()
+        self.ts.backfill()
+        start = datetime.now(utc) - timedelta(seconds=1)
+        end = start + timedelta(hours=1)
+
+        # Fills the gap in front of ticket 3
+        self.ts.move(6, self.ts.position(3))
+        self.assertEqual({6: 3},
+                         self.ts.positions_if_moved('milestone1', start, end))
+
+        # No gap left, so the tickets from ticket 3 on are renumbered and
+        # logged along with the moved ticket
+        before = self._sparse_positions()
+        self.ts.move(5, self.ts.position(3))
+        after = self._sparse_positions()
+        changed = dict((tkt, pos) for tkt, pos in after.iteritems()
+                       if before[tkt] != pos)
+        self.assertTrue(len(changed) > 1)
+        self.assertEqual(dict(changed, **{6: after[6]}),
+                         self.ts.positions_if_moved('milestone1', start, end))
+        self.assertEqual(len(changed) - 1,
+                         len([move for move in self.ts.moves_since(start)
+                              if move[0] != 5 and move[0] != 6]))
+
 # used if you run this not via setup.py test
 def suite():
     suite = unittest.TestSuite()
@@ -0,0 +1,149 @@
+import unittest
+from trac.db import Column, DatabaseManager, Table
+from trac.perm import PermissionCache
+from trac.test import EnvironmentStub, Mock
+from trac.util.datefmt import utc
+
+from agiletools import taskboard
+from agiletools.api import AgileToolsSystem
+from agiletools.taskboard import TaskboardModule
+
+from trac.ticket.api import TicketSystem
+from trac.ticket.model import Priority, Ticket
+
+class TaskboardTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'agiletools.*'], default_data=True)
+        self.env.config.set('ticket-custom', 'phase', 'select')
+        self.env.config.set('ticket-custom', 'phase.options', 'design|build')
+        self.env.config.set('ticket-custom', 'phase.value', 'build')
+        TicketSystem(self.env).reset_ticket_fields()
+        AgileToolsSystem(self.env).environment_created()
+        self.tm = TaskboardModule(self.env)
+
+    def tearDown(self):
+        self._execute("DROP TABLE IF EXISTS kanban_limits")
+        self.env.reset_db()
+
+    def _insert(self, **values):
+        ticket = Ticket(self.env)
+        ticket.populate(values)
+        return ticket.insert()
+
+    def _execute(self, sql, *args):
+        @self.env.with_transaction()
+        def do_execute(db):
+            db.cursor().execute(sql, args)
+
+    def _create_kanban_limits(self):
+        # Status limits are kept by the kanban plugin
+        table = Table('kanban_limits', key=('milestone', 'status'))[
+            Column('milestone'), Column('status'),
+            Column('hardlimit', type='int')]
+        connector = DatabaseManager(self.env).get_connector()[0]
+        for sql in connector.to_sql(table):
+            self._execute(sql)
+
+    def _field(self, name):
+        return [f for f in TicketSystem(self.env).get_ticket_fields()
+                if f['name'] == name][0]
+
+    def test_group_values(self):
+        ids = [self._insert(phase='design', priority='minor'),
+               self._insert(), self._insert(), self._insert(), self._insert()]
+        # NULL values get the default, empty and missing custom values don't
+        self._execute("UPDATE ticket_custom SET value='' "
+                      "WHERE ticket=%s AND name='phase'", ids[1])
+        self._execute("UPDATE ticket SET priority='' WHERE id=%s", ids[1])
+        self._execute("UPDATE ticket_custom SET value=NULL "
+                      "WHERE ticket=%s AND name='phase'", ids[2])
+        self._execute("UPDATE ticket SET priority=NULL WHERE id=%s", ids[2])
+        self._execute("DELETE FROM ticket_custom "
+                      "WHERE ticket=%s AND name='phase'", ids[3])
+        results = [{'id': id_} for id_ in ids]
+
+        for name in ('phase', 'priority'):
+            self.assertEqual(dict((id_, Ticket(self.env, id_)
+                                        .get_value_or_default(name) or "")
+                                  for id_ in ids),
+                             self.tm._get_group_values(results,
+                                 self._field(name), chunk_size=2))
+        phases = self.tm._get_group_values(results, self._field('phase'))
+        self.assertEqual(['design', '', 'build', '', 'build'],
+                         [phases[id_] for id_ in ids])
+
+    def test_status_actions_per_status(self):
+        self._create_kanban_limits()
+        for type_, status in [('defect', 'new'), ('defect', 'new'),
+                              ('defect', 'assigned'), ('task', 'new'),
+                              ('task', 'new'), ('defect', 'new')]:
+            self._insert(type=type_, status=status, milestone='milestone1')
+        req = Mock(authname='anonymous', href=self.env.href, args={},
+                   perm=PermissionCache(self.env, 'anonymous'), tz=utc,
+                   locale=None, lc_time=None)
+        results = self.tm._get_permitted_tickets(req,
+                                                 {'milestone': ['milestone1']})
+
+        orig_operation, orig_ticket = taskboard.Operation, taskboard.Ticket
+        built = []
+        class Operation(orig_operation):
+            def __init__(self, *args, **kwargs):
+                built.append(args[2])
+                orig_operation.__init__(self, *args, **kwargs)
+        loaded = []
+        class Ticket(orig_ticket):
+            def __init__(self, env, tkt_id=None, *args, **kwargs):
+                loaded.append(tkt_id)
+                orig_ticket.__init__(self, env, tkt_id, *args, **kwargs)
+
+        taskboard.Operation, taskboard.Ticket = Operation, Ticket
+        try:
+            data = self.tm._get_status_data(req, 'milestone1',
+                                            self._field('status'), results,
+                                            set(['summary']))
+        finally:
+            taskboard.Operation = orig_operation
+            taskboard.Ticket = orig_ticket
+
+        # One for each type and status
+        self.assertEqual(3, len(built))
+        self.assertEqual(3, len(loaded))
+        self.assertEqual(6, sum(len(tickets)
+                                for statuses in data[1].itervalues()
+                                for tickets in statuses.itervalues()))
+
+    def test_response_state(self):
+        self._create_kanban_limits()
+        state = lambda group: self.tm._response_state('milestone1', group)
+
+        # Grouped by status unless grouped by a valid field
+        by_status = state('status')
+        self.assertEqual(by_status, state('summary'))
+
+        # Status limits of the milestone
+        self._execute("INSERT INTO kanban_limits VALUES (%s,%s,%s)",
+                      'milestone2', 'new', 3)
+        self.assertEqual(by_status, state('status'))
+        self._execute("INSERT INTO kanban_limits VALUES (%s,%s,%s)",
+                      'milestone1', 'new', 3)
+        self.assertNotEqual(by_status, state('status'))
+
+        # Which users are shown as columns
+        by_owner = state('owner')
+        self.env.config.set('taskboard', 'user_columns', 'used')
+        self.assertNotEqual(by_owner, state('owner'))
+
+        # Options of the field grouped by
+        by_priority = state('priority')
+        priority = Priority(self.env)
+        priority.name = 'trivial2'
+        priority.insert()
+        self.assertNotEqual(by_priority, state('priority'))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TaskboardTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest="suite")
@@ -0,0 +1,99 @@
+import unittest
+from trac.test import EnvironmentStub, Mock
+from trac.web.href import Href
+
+from agiletools.users import SimplifiedPermissions, UserDirectory
+
+class Member(dict):
+    def __init__(self, sid, name):
+        dict.__init__(self, name=name)
+        self.sid = sid
+
+class UserDirectoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'agiletools.*'], default_data=True)
+        self.ud = UserDirectory(self.env)
+
+        @self.env.with_transaction()
+        def do_insert(db):
+            cursor = db.cursor()
+            cursor.executemany("""
+                INSERT INTO session_attribute (sid, authenticated, name, value)
+                VALUES (%s, %s, %s, %s)""",
+                [('alice', 1, 'name', 'Alice Smith'),
+                 ('bob', 1, 'email', 'bob@example.org'),
+                 ('carol', 0, 'name', 'Anonymous Carol')])
+
+    def _rename(self, sid, name):
+        @self.env.with_transaction()
+        def do_rename(db):
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE session_attribute SET value=%s
+                WHERE sid=%s AND name='name'""", (name, sid))
+
+    def test_display_names(self):
+        self.assertEqual({'alice': 'Alice Smith', 'bob': 'bob',
+                          'carol': 'carol'},
+                         self.ud.display_names(['alice', 'bob', 'carol', '']))
+
+    def test_cached_until_own_change(self):
+        self.ud.display_names(['alice', 'bob'])
+        self._rename('alice', 'Alice Jones')
+        self.assertEqual('Alice Smith', self.ud.display_names(['alice'])['alice'])
+
+        # Alice's own requests carry her new name
+        req = Mock(authname='alice', session={'name': 'Alice Jones'},
+                   method='GET', path_info='/taskboard')
+        self.ud.pre_process_request(req, None)
+        self.assertEqual('Alice Jones', self.ud.display_names(['alice'])['alice'])
+
+    def test_session_only_on_board_pages(self):
+        self.ud.display_names(['alice'])
+        self._rename('alice', 'Alice Jones')
+
+        # Other pages don't load the session
+        req = Mock(authname='alice', session=None, method='GET',
+                   path_info='/wiki')
+        self.ud.pre_process_request(req, None)
+        self.assertEqual('Alice Smith', self.ud.display_names(['alice'])['alice'])
+
+        # Saving the preferences drops the cached name
+        req = Mock(authname='alice', session=None, method='POST',
+                   path_info='/prefs')
+        self.ud.pre_process_request(req, None)
+        self.assertEqual('Alice Jones', self.ud.display_names(['alice'])['alice'])
+
+    def test_no_cache(self):
+        self.env.config.set('agiletools', 'display_name_ttl', 0)
+        self.ud.display_names(['alice'])
+        self._rename('alice', 'Alice Jones')
+        self.assertEqual('Alice Jones', self.ud.display_names(['alice'])['alice'])
+
+    def test_group_members(self):
+        groups = {'developers': {'members': [Member('bob', 'Bob'),
+                                             Member('alice', 'Alice')]}}
+        SimplifiedPermissions(self.env).group_memberships = lambda: groups
+        href = Href('/trac')
+
+        user_data, sids = self.ud.group_members(href)
+        self.assertEqual(['alice', 'bob'], sids)
+        self.assertEqual({'name': 'Bob', 'avatar': '/trac/avatar/bob'},
+                         user_data['bob'])
+
+        # Kept until something is changed through the admin pages
+        groups['developers']['members'].append(Member('carol', 'Carol'))
+        self.assertEqual(['alice', 'bob'], self.ud.group_members(href)[1])
+        req = Mock(authname='admin', session={}, method='POST',
+                   path_info='/admin/general/simplepermissions')
+        self.ud.pre_process_request(req, None)
+        self.assertEqual(['alice', 'bob', 'carol'],
+                         self.ud.group_members(href)[1])
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(UserDirectoryTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest="suite")
@@ -0,0 +1,39 @@
+import unittest
+from trac.test import EnvironmentStub, Mock
+
+from agiletools.workflows import WorkflowCatalogue
+
+class WorkflowCatalogueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'agiletools.*'], default_data=True)
+        self.catalogue = WorkflowCatalogue(self.env)
+
+    def _request(self, method, path_info):
+        req = Mock(method=method, path_info=path_info)
+        self.catalogue.pre_process_request(req, None)
+
+    def test_reset_on_admin_post(self):
+        closed = self.catalogue._closed_statuses
+        workflows = self.catalogue._workflows
+        self.assertEqual(closed, self.catalogue.closed_statuses())
+
+        self._request('GET', '/admin/ticket/workflow')
+        self._request('POST', '/backlog')
+        self.assertTrue(closed is self.catalogue._closed_statuses)
+        self.assertTrue(workflows is self.catalogue._workflows)
+
+        self._request('POST', '/admin/ticket/workflow')
+        self.assertFalse(closed is self.catalogue._closed_statuses)
+        self.assertFalse(workflows is self.catalogue._workflows)
+
+    def test_closed_statuses_copied(self):
+        self.catalogue.closed_statuses()['defect'] = []
+        self.assertFalse(self.catalogue.closed_statuses().get('defect') == [])
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(WorkflowCatalogueTestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest="suite")
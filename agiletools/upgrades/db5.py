@@ -0,0 +1,6 @@
+def do_upgrade(env, ver, cursor):
+    """Add an index on ticket_positions.position for range updates and
+    ordering by position
+    """
+    cursor.execute("CREATE INDEX ticket_positions_position_idx "
+                   "ON ticket_positions (position)")
@@ -0,0 +1,11 @@
+from agiletools import db_default
+
+def do_upgrade(env, ver, cursor):
+    """Add the counter of writes to ticket_positions, which writers bump to
+    queue up behind each other
+    """
+    cursor.execute("SELECT value FROM system WHERE name = %s",
+                   (db_default.generation_name, ))
+    if cursor.fetchone() is None:
+        cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",
+                       (db_default.generation_name, '0'))
@@ -0,0 +1,120 @@
+#
+# Copyright (C) 2015 CGI IT UK Ltd
+# All rights reserved.
+#
+
+from trac.config import IntOption
+from trac.core import Component, implements
+from trac.web.api import IRequestFilter
+
+from agiletools.api import chunked_in
+from agiletools.cache import TTLCache
+
+from simplifiedpermissionsadminplugin.simplifiedpermissions import SimplifiedPermissions
+
+class UserDirectory(Component):
+    """Looks up the display names of users in bulk, keeping them in memory
+    for a while."""
+
+    implements(IRequestFilter)
+
+    display_name_ttl = IntOption("agiletools", "display_name_ttl", 300,
+        doc="""Number of seconds for which the display names of users are
+        kept in memory by the backlog and task board. A user's own name is
+        refreshed as soon as they save their preferences or open the
+        backlog or task board. Names changed for other users, e.g. by an
+        admin, are only noticed once this time has passed. 0 looks the
+        names up on every request.""")
+
+    group_member_ttl = IntOption("agiletools", "group_member_ttl", 300,
+        doc="""Number of seconds for which the members of the permission
+        groups, shown as columns when the task board is grouped by user, are
+        kept in memory. They are looked up again straight away after a
+        change made through the admin pages of this server process. 0 looks
+        them up on every request.""")
+
+    def __init__(self):
+        self._names = TTLCache(self.display_name_ttl)
+        self._members = TTLCache(self.group_member_ttl)
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        # Pick up changes to the user's own name straight away. Only the
+        # pages showing names compare it with the session, so other
+        # requests don't have to load it.
+        if req.authname and req.authname != 'anonymous':
+            if req.method == 'POST' and req.path_info.startswith('/prefs'):
+                self._names.invalidate(req.authname)
+            elif req.path_info.startswith(('/backlog', '/taskboard')):
+                found, _ = self._names.get_many([req.authname])
+                if req.authname in found:
+                    name = req.session.get('name') or None
+                    if found[req.authname] != name:
+                        self._names.set(req.authname, name)
+        # Any admin page may change the permission groups or their members
+        if req.method == 'POST' and req.path_info.startswith('/admin'):
+            self._members.clear()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return (template, data, content_type)
+
+    # Own methods
+    def display_names(self, sids, chunk_size=500):
+        """Return a dict mapping each of `sids` to the name set in their
+        preferences, or to the sid itself when they haven't set one.
+
+        Names which aren't cached are looked up with one query per
+        `chunk_size` users.
+        """
+        sids = set(sid for sid in sids if sid)
+        if self.display_name_ttl > 0:
+            names, missing = self._names.get_many(sids)
+        else:
+            names, missing = {}, list(sids)
+
+        if missing:
+            fetched = dict.fromkeys(missing)
+            db = self.env.get_read_db()
+            cursor = db.cursor()
+            fetched.update((sid, value or None)
+                           for sid, value in chunked_in(cursor, """
+                    SELECT sid, value FROM session_attribute
+                    WHERE authenticated=1 AND name='name' AND sid IN (%s)
+                    """, missing, chunk_size))
+            if self.display_name_ttl > 0:
+                self._names.set_many(fetched.iteritems())
+            names.update(fetched)
+
+        return dict((sid, name or sid) for sid, name in names.iteritems())
+
+    def group_members(self, href=None):
+        """Return a dict mapping the sid of every member of a permission
+        group to a dict with their `name` and `avatar` URL (made with `href`,
+        or None without), and a list of the sids sorted by name.
+        """
+        key = href() if href is not None else None
+        if self.group_member_ttl > 0:
+            members = self._members.get(key)
+        else:
+            members = None
+
+        if members is None:
+            user_data = {}
+            sp = SimplifiedPermissions(self.env)
+            for group, data in sp.group_memberships().items():
+                for member in data['members']:
+                    if member.sid not in user_data:
+                        user_data[member.sid] = {
+                            'name': member.get("name", member.sid),
+                            'avatar': href and href.avatar(member.sid) or None
+                        }
+            sids = sorted(user_data,
+                          key=lambda sid: (user_data[sid]['name'], sid))
+            members = (user_data, sids)
+            if self.group_member_ttl > 0:
+                self._members.set(key, members)
+
+        # Callers add other users to their copy
+        user_data, sids = members
+        return dict(user_data), list(sids)
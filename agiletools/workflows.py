@@ -0,0 +1,60 @@
+#
+# Copyright (C) 2015 CGI IT UK Ltd
+# All rights reserved.
+#
+
+from trac.cache import cached
+from trac.core import Component, implements
+from trac.web.api import IRequestFilter
+
+from logicaordertracker.controller import LogicaOrderController
+
+class WorkflowCatalogue(Component):
+    """Keeps the ticket workflows and their closed statuses used by the
+    backlog and task board in memory until an admin page is posted."""
+
+    implements(IRequestFilter)
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        # Workflows are edited on admin pages, or in trac.ini which
+        # reloads the environment
+        if req.method == 'POST' and req.path_info.startswith('/admin'):
+            self.reset()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return (template, data, content_type)
+
+    # Own methods
+    def reset(self):
+        del self._closed_statuses
+        del self._workflows
+
+    def closed_statuses(self):
+        """Return a dict of the closed statuses of each ticket type which
+        has any, sorted."""
+        return dict((type_, list(statuses))
+                    for type_, statuses in self._closed_statuses.iteritems())
+
+    def workflow(self, type_):
+        """Return the workflow of tickets of type `type_`."""
+        workflows = self._workflows
+        try:
+            return workflows[type_]
+        except KeyError:
+            loc = LogicaOrderController(self.env)
+            workflow = workflows[type_] = loc._get_workflow_for_typename(type_)
+            return workflow
+
+    @cached
+    def _closed_statuses(self, db):
+        loc = LogicaOrderController(self.env)
+        closed = loc.type_and_statuses_for_closed_statusgroups()
+        return dict((type_, sorted(statuses))
+                    for type_, statuses in closed.iteritems() if statuses)
+
+    @cached
+    def _workflows(self, db):
+        # Filled in as workflows are asked for
+        return {}
@@ -34,6 +34,10 @@ setup(
             'agiletools.backlog = agiletools.backlog',
             'agiletools.taskboard = agiletools.taskboard',
             'agiletools.api    = agiletools.api',
+            'agiletools.admin  = agiletools.admin',
+            'agiletools.users  = agiletools.users',
+            'agiletools.milestones = agiletools.milestones',
+            'agiletools.workflows = agiletools.workflows',
         ]
     },
 )